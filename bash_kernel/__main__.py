@@ -1,3 +1,9 @@
+import sys
+
+if sys.argv[1:2] == ['run']:
+    from .runner import main
+    sys.exit(main(sys.argv[2:]))
+
 from ipykernel.kernelapp import IPKernelApp
 from .kernel import BashKernel
 IPKernelApp.launch_instance(kernel_class=BashKernel)
@@ -0,0 +1,192 @@
+"""binary.py keeps binary data printed by mistake (`cat archive.tar.gz`) out of the output.
+
+Decoded as UTF-8, binary data would turn into megabytes of replacement characters, searched
+for rich content markers and sent to the frontend, which can hardly render it. Instead, bash
+is spawned as a `FilteringSpawn`, which decodes every chunk read from bash with a
+`BinaryOutputFilter`. The filter looks at the raw bytes: when a chunk holds at least
+`BINARY_MIN_COUNT` control bytes that text doesn't use (NULs and the like, but not tabs,
+backspaces, carriage returns or escape sequences), and these bytes together with invalid UTF-8
+make up more than `BINARY_RATIO` of it, the output turns binary. Text in another encoding,
+e.g. Latin-1, is invalid UTF-8 but holds no such control bytes, so it is passed on, with
+replacement characters. From there, chunks are dropped (only counted) as long as they hold
+control bytes or invalid UTF-8, and a single line replaces them:
+
+    [binary output not shown: 48,203,776 bytes, starting with 1f 8b 08 00 ...]
+
+The binary stretch ends with the first chunk of clean text, or when the bash prompt shows
+up after the last invalid byte: the prompt is always passed on, so the kernel keeps reading
+until it, and the session stays usable. Text after the last invalid byte of a chunk is held
+back until the next chunk, in case it is the start of the prompt. When the stretch ends, the
+rest of the line of its last invalid byte, up to the line break or the prompt, is binary data
+that happens to be valid, and is dropped as well.
+
+Invalid bytes are decoded as lone surrogates (the 'surrogateescape' error handler), so they
+can be told apart from replacement characters the program printed, and counted by encoding
+the text back. That is only needed for chunks that aren't plain ASCII, so text output is
+hardly slowed down. Text passed on has them replaced with U+FFFD, as pexpect would.
+"""
+import codecs
+import errno
+import os
+import re
+
+import pexpect
+from pexpect.spawnbase import SpawnBase
+
+
+# Fraction of the bytes of a chunk that are control bytes or invalid UTF-8 past which the
+# output is considered binary. Random data has about half of them.
+BINARY_RATIO = 0.3
+
+# Minimum number of control bytes in a chunk for it to be considered binary, so that a few
+# stray ones are not taken for binary data.
+BINARY_MIN_COUNT = 8
+
+# Number of bytes shown, in hex, at the start of a binary stretch.
+PREVIEW_BYTES = 16
+
+# Longest text after the last invalid byte of a binary chunk that is held back, as it may
+# be the start of the prompt. Longer text ends the binary stretch.
+MAX_HELD_LENGTH = 4096
+
+
+def _size(data):
+    """Returns the number of bytes the program printed, given data read from the terminal,
+    which turns every '\\n' into '\\r\\n'."""
+    return len(data) - data.count(b'\r\n')
+
+
+# C0 control bytes that text doesn't use: all but BEL, BS, TAB, LF, VT, FF, CR and ESC.
+_CONTROL_BYTES = bytes(range(0x00, 0x07)) + bytes(range(0x0e, 0x1b)) + bytes(range(0x1c, 0x20))
+
+# A control byte, or an invalid byte decoded with the 'surrogateescape' error handler.
+_INVALID_RE = re.compile('[\x00-\x06\x0e-\x1a\x1c-\x1f\udc80-\udcff]')
+_ESCAPED_RE = re.compile('[\udc80-\udcff]')
+
+# The `(envname) ` conda adds in front of the prompt, see `IREPLWrapper.ps1_re`.
+_ENV_RE = re.compile(r'(\(\w+\) )?\Z')
+
+
+def _count_invalid(data, text):
+    """Returns the number of control bytes, and that of invalid UTF-8 bytes, in data,
+    decoded as text."""
+    controls = len(data) - len(data.translate(None, _CONTROL_BYTES))
+    invalid = 0
+    if not data.isascii():
+        # Encoding ignores the lone surrogates the invalid bytes were decoded to.
+        invalid = (len(text.encode('utf-8', 'surrogateescape'))
+                   - len(text.encode('utf-8', 'ignore')))
+    return controls, invalid
+
+
+def _last_invalid(text):
+    """Returns the position following the last control or invalid byte in text."""
+    match = _INVALID_RE.search(text[::-1])
+    return len(text) - match.start() if match is not None else 0
+
+
+class BinaryOutputFilter:
+    """An incremental UTF-8 decoder replacing binary stretches of the data with a summary.
+
+    :param prompt: the fixed part of the bash prompts, which ends binary stretches.
+    """
+    def __init__(self, prompt):
+        self.decoder = codecs.getincrementaldecoder('utf-8')('surrogateescape')
+        self.prompt = prompt
+        self.binary = False
+        self._bytes = 0
+        self._preview = b''
+        self._held = ''
+        self._line_start = True
+
+    def decode(self, data, final=False):
+        text = self.decoder.decode(data, final)
+        controls, invalid = _count_invalid(data, text)
+        count = controls + invalid
+        if not self.binary:
+            if controls < BINARY_MIN_COUNT or count < len(data) * BINARY_RATIO:
+                if invalid:
+                    text = _ESCAPED_RE.sub('\ufffd', text)
+                return self._passed_on(text)
+            # Pass on the lines preceding the first invalid byte.
+            first = _INVALID_RE.search(text).start()
+            start = text.rfind('\n', 0, first) + 1
+            head, text = text[:start], text[start:]
+            head_bytes = len(head.encode('utf-8'))
+            self.binary = True
+            self._bytes = _size(data[head_bytes:])
+            self._preview = data[head_bytes:head_bytes + PREVIEW_BYTES]
+        else:
+            head = ''
+            self._bytes += _size(data)
+            text, self._held = self._held + text, ''
+            if not count:
+                return self._end(head, text)
+        tail = text[_last_invalid(text):]
+        if self.prompt in tail or len(tail) > MAX_HELD_LENGTH or final:
+            return self._end(head, tail)
+        self._held = tail
+        return self._passed_on(head)
+
+    def _end(self, head, tail):
+        """Ends the binary stretch, passing on its summary followed by tail, less the rest
+        of the line the binary data was on."""
+        self.binary = False
+        end = tail.find('\n') + 1 or len(tail)
+        prompt = tail.find(self.prompt, 0, end) if self.prompt else -1
+        if prompt != -1:
+            tail = tail[_ENV_RE.search(tail, 0, prompt).start():]
+        else:
+            # The summary ends the line instead of its line break, which isn't counted.
+            if tail.endswith('\n', 0, end):
+                self._bytes -= 1
+            tail = tail[end:]
+        self._bytes -= _size(tail.encode('utf-8', 'surrogateescape'))
+        summary = '[binary output not shown: {:,} bytes, starting with {}]\n'.format(
+            self._bytes, self._preview.hex(' '))
+        if not (head.endswith('\n') if head else self._line_start):
+            # Terminate the partial line preceding the binary data.
+            summary = '\n' + summary
+        return self._passed_on(head + summary + tail)
+
+    def _passed_on(self, text):
+        if text:
+            # Output starts on a new line after a prompt as well.
+            last_line = text[text.rfind('\n') + 1:]
+            self._line_start = not last_line or self.prompt in last_line
+        return text
+
+
+class _FilteredReader(SpawnBase):
+    """Reads from the child like SpawnBase, but decodes the data with `output_filter`.
+
+    `pexpect.spawn` waits for the data to read, and leaves reading it to SpawnBase, which
+    its subclasses are meant to override for that.
+    """
+    output_filter = None
+
+    def read_nonblocking(self, size=1, timeout=None):
+        try:
+            data = os.read(self.child_fd, size)
+        except OSError as err:
+            if err.errno == errno.EIO:
+                # Linux-style EOF
+                self.flag_eof = True
+                raise pexpect.EOF('End Of File (EOF). Exception style platform.')
+            raise
+        if not data:
+            # BSD-style EOF
+            self.flag_eof = True
+            raise pexpect.EOF('End Of File (EOF). Empty string style platform.')
+        return self.output_filter.decode(data)
+
+
+class FilteringSpawn(pexpect.spawn, _FilteredReader):
+    """A `pexpect.spawn` decoding the output of the child as UTF-8, with its binary stretches
+    summarized.
+
+    :param prompt: the fixed part of the bash prompts, see `BinaryOutputFilter`.
+    """
+    def __init__(self, command, args=[], prompt='', **kwargs):
+        super().__init__(command, args, encoding='utf-8', **kwargs)
+        self.output_filter = BinaryOutputFilter(prompt)
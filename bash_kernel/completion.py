@@ -0,0 +1,109 @@
+"""completion.py holds the bash side of tab completion.
+
+`build_cmds()` defines a bash function, `__bash_kernel_complete`, that finds all the
+candidates for a completion request in a single call, so that `BashKernel.do_complete`
+needs only one round-trip to bash per request:
+
+$ __bash_kernel_complete <max_results> "<kinds>" <word> [<command line>]
+
+`<kinds>` is a space separated list of the kinds of candidates wanted:
+
+- d: directories (with a trailing "/")
+- f: files and directories
+- c: commands: aliases, builtins, functions and executables in $PATH
+- v: variables (the word may start with "$")
+- p: the programmable completion (`complete -p`) defined for the command being
+  completed, if any (e.g. the ones of git or kubectl). Needs the command line up to
+  the cursor.
+
+Each candidate is output on one line, prefixed by its kind and a space. At most
+`<max_results>` candidates of each kind are output, so that completing in huge
+directories stays fast. The candidates are framed by the _COMPLETIONS_BEGIN and
+_COMPLETIONS_END lines, so that any unrelated output (e.g. from background jobs)
+is ignored by `parse_completions()`.
+"""
+
+_COMPLETIONS_BEGIN = "bash_kernel: completions begin"
+_COMPLETIONS_END = "bash_kernel: completions end"
+
+_COMPLETE_CMD = """
+__bash_kernel_complete () {
+    local __bk_max="$1" __bk_kinds="$2" __bk_cur="$3" __bk_line="$4" __bk_kind
+    echo "%(begin)s"
+    for __bk_kind in $__bk_kinds; do
+        case "$__bk_kind" in
+            d) __bash_kernel_complete_kind d "$__bk_max" compgen -d -S / -- "$__bk_cur" ;;
+            f) __bash_kernel_complete_kind f "$__bk_max" compgen -f -- "$__bk_cur" ;;
+            c) __bash_kernel_complete_kind c "$__bk_max" compgen -abc -A function -- "$__bk_cur" ;;
+            v) __bash_kernel_complete_kind v "$__bk_max" compgen -A arrayvar -A export -A variable -- "${__bk_cur#\\$}" ;;
+            p) __bash_kernel_complete_programmable "$__bk_max" "$__bk_line" ;;
+        esac
+    done 2>/dev/null
+    echo "%(end)s"
+}
+
+__bash_kernel_complete_kind () {
+    local __bk_kind="$1" __bk_max="$2" __bk_n=0 __bk_candidate
+    shift 2
+    while IFS= read -r __bk_candidate; do
+        echo "$__bk_kind $__bk_candidate"
+        (( ++__bk_n < __bk_max )) || break
+    done < <("$@")
+}
+
+__bash_kernel_complete_programmable () {
+    local __bk_max="$1" COMP_LINE="$2" COMP_POINT="${#2}" COMP_TYPE=9 COMP_KEY=9
+    local -a COMP_WORDS COMPREPLY=()
+    local COMP_CWORD __bk_spec __bk_n=0 __bk_candidate
+    read -ra COMP_WORDS <<< "$COMP_LINE"
+    if [[ -z "$COMP_LINE" || "$COMP_LINE" == *[[:space:]] ]]; then
+        COMP_WORDS+=("")
+    fi
+    COMP_CWORD=$(( ${#COMP_WORDS[@]} - 1 ))
+    (( COMP_CWORD > 0 )) || return 0
+    set -- "${COMP_WORDS[0]}" "${COMP_WORDS[COMP_CWORD]}" "${COMP_WORDS[COMP_CWORD-1]}"
+    __bk_spec=$(complete -p -- "$1" 2>/dev/null)
+    if [[ -z "$__bk_spec" ]]; then
+        # bash-completion loads most completions on demand, with a default completion.
+        __bk_spec=$(complete -p -D 2>/dev/null)
+        if [[ "$__bk_spec" =~ [[:space:]]-F[[:space:]]+([^[:space:]]+) ]]; then
+            "${BASH_REMATCH[1]}" "$@"
+            [[ $? == 124 ]] && __bk_spec=$(complete -p -- "$1" 2>/dev/null) || __bk_spec=""
+        else
+            __bk_spec=""
+        fi
+    fi
+    [[ -n "$__bk_spec" ]] || return 0
+    if [[ "$__bk_spec" =~ [[:space:]]-F[[:space:]]+([^[:space:]]+) ]]; then
+        "${BASH_REMATCH[1]}" "$@"
+    else
+        # Other completion specifications are also understood by compgen: drop the
+        # leading "complete" and the trailing command name.
+        __bk_spec="${__bk_spec#complete }"
+        mapfile -t COMPREPLY < <(eval "compgen ${__bk_spec%% *} -- \\"\\$2\\"")
+    fi
+    for __bk_candidate in "${COMPREPLY[@]}"; do
+        echo "p $__bk_candidate"
+        (( ++__bk_n < __bk_max )) || break
+    done
+}
+""" % {'begin': _COMPLETIONS_BEGIN, 'end': _COMPLETIONS_END}
+
+
+def build_cmds():
+    return _COMPLETE_CMD
+
+
+def parse_completions(output):
+    """Returns a dict mapping each kind to the list of its candidates, from the output of
+    `__bash_kernel_complete`."""
+    completions = {}
+    in_frame = False
+    for line in output.splitlines():
+        if line == _COMPLETIONS_BEGIN:
+            in_frame = True
+        elif line == _COMPLETIONS_END:
+            break
+        elif in_frame and len(line) > 2 and line[1] == ' ':
+            completions.setdefault(line[0], []).append(line[2:])
+    return completions
@@ -1,14 +1,26 @@
 """display.py holds the functions needed to display different types of content.
 
 To use specialized content (images, html, etc) this file defines (in `build_cmds()`) bash functions
-that take the contents as standard input. Currently, `display` (images), `displayHTML` (html)
-and `displayJS` (javascript) are supported.
+that take the contents as standard input. Currently, `display` (images), `displayHTML` (html),
+`displayJS` (javascript) and `displayTable` (CSV/TSV, see table.py) are supported.
 
 Example:
 
 $ cat dog.png | display
 $ echo "<b>Dog</b>, not a cat." | displayHTML
 $ echo "alert('It is known khaleesi\!');" | displayJS
+$ cat results.tsv | displayTable --rows=5
+
+Images can optionally be downscaled and/or converted before being sent to the frontend,
+which keeps notebooks small when the images are much larger than what is displayed. This
+needs Pillow (`pip install bash_kernel[images]`):
+
+$ cat microscope.png | display --max-size=1024x768 --format=webp --quality=80
+
+The contents are saved to a temporary file, in the memory backed /dev/shm if $TMPDIR isn't
+set and it has plenty of free space (see `display_dir()`), and mapped into memory by the
+kernel rather than copied. Tables can be far
+too large for that: `displayTable` saves a summary of its input instead (see table.py).
 
 ### Updating rich content cells
 
@@ -26,9 +38,9 @@ while ((ii < 10)) ; do
 done
 echo
 
-Remember to create a new id each time the cell is executed.javascript. The same
-will work for images or even javascript content (execute javascript snippet
-without creating new output cells for each execution).
+Display ids are only remembered within one execution, so re-running the cell creates the
+output anew. The same will work for images or even javascript content (execute javascript
+snippet without creating new output cells for each execution).
 
 ## Programmatically generating rich content
 
@@ -38,8 +50,8 @@ constant. So one can write programs (C++, Go, Rust, etc.) that generates rich co
 appropriately.
 
 The environment variable "NOTEBOOK_BASH_KERNEL_CAPABILITIES" will be set with a comma
-separated list of the supported types (currently "image,html,javascript") that a program can check
-for.
+separated list of the supported types (currently "image,html,javascript,table") that a program
+can check for.
 
 To output to a particular "display_id", to allow update of content, prefix the filename
 with "(<display_id>)". E.g: a line to display the contents of /tmp/myHTML.html to
@@ -47,81 +59,224 @@ a display id "id_12345" would look like:
 
 bash_kernel: saved html data to: (id_12345) /tmp/myHTML.html
 
+Options of the display functions are passed before those as "[<name>=<value> ...] ", e.g.:
+
+bash_kernel: saved image data to: [max-size=800x600 format=webp] (id_12345) /tmp/plot.png
+
+Only the options listed in CONTENT_DATA_PREFIXES for the type of content are accepted, others
+are reported to the user.
+
 To add support to new content types: (1) create a constant _TEXT_SAVED_<new_type>; (2) create a function
 display_data_for_<new_type>; (3) Create an entry in CONTENT_DATA_PREFIXES. Btw, `$ jupyter-lab --Session.debug=True`
 is your friend to debug the format of the content message.
 """
 import base64
+import contextlib
+import io
 import json
+import mmap
 import os
 import re
+import shlex
+import sys
 
-import filetype
+from .table import TABLE_ROWS, table_display_data
 
 
+# Common start of all the _TEXT_SAVED_* prefixes.
+TEXT_SAVED_PREFIX = "bash_kernel: saved "
 _TEXT_SAVED_IMAGE = "bash_kernel: saved image data to: "
 _TEXT_SAVED_HTML = "bash_kernel: saved html data to: "
 _TEXT_SAVED_JAVASCRIPT = "bash_kernel: saved javascript data to: "
+_TEXT_SAVED_TABLE = "bash_kernel: saved table data to: "
+
+# Summarizes the input of displayTable, with the options given to it.
+_TABLE_SAVE_CMD = '"$__bash_kernel_python" %s rows="$__bash_kernel_table_rows" "${__bk_options[@]}"' % (
+    shlex.quote(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'table.py')))
 
-def _build_cmd_for_type(display_cmd, line_prefix):
+def _build_cmd_for_type(display_cmd, line_prefix, save_cmd='cat'):
     return """
 %s () {
+    local -a __bk_options=()
+    while [[ "$1" == --?* ]]; do
+        if [[ "$1" == *=* ]]; then
+            __bk_options+=("${1#--}"); shift;
+        else
+            (( $# >= 2 )) || { echo "%s: --${1#--} needs a value" >&2; return 2; }
+            __bk_options+=("${1#--}=$2"); shift 2;
+        fi
+    done
     display_id="$1"; shift;
-    TMPFILE=$(mktemp ${TMPDIR-/tmp}/bash_kernel.XXXXXXXXXX)
-    cat > $TMPFILE
+    TMPFILE=$(mktemp "${__bash_kernel_display_dir:-${TMPDIR-/tmp}}/bash_kernel.XXXXXXXXXX")
+    %s > "$TMPFILE" || { local __bk_status=$?; rm -f -- "$TMPFILE"; return $__bk_status; }
     prefix="%s"
+    if (( ${#__bk_options[@]} )); then
+        prefix="${prefix}[${__bk_options[*]}] "
+    fi
     if [[ "${display_id}" != "" ]]; then
         echo "${prefix}(${display_id}) $TMPFILE" >&2
     else
         echo "${prefix}$TMPFILE" >&2
     fi
 }
-""" % (display_cmd, line_prefix)
-
-
-def build_cmds():
-    commands = []
+""" % (display_cmd, display_cmd, save_cmd, line_prefix)
+
+
+def build_cmds(display_dir=None, table_rows=TABLE_ROWS):
+    """Returns the bash commands defining the display functions. They save the contents to
+    display_dir (or $TMPDIR): ideally a memory backed directory, see `display_dir()`.
+    `displayTable` shows table_rows rows at the start and at the end of tables by default."""
+    commands = [
+        '__bash_kernel_python=' + shlex.quote(sys.executable),
+        '__bash_kernel_table_rows=%d' % table_rows,
+    ]
+    if display_dir is not None:
+        commands.append('__bash_kernel_display_dir=' + shlex.quote(display_dir))
     capabilities = []
     for line_prefix, info in CONTENT_DATA_PREFIXES.items():
-        commands.append(_build_cmd_for_type(info['display_cmd'], line_prefix))
+        commands.append(_build_cmd_for_type(info['display_cmd'], line_prefix,
+                                            info.get('save_cmd', 'cat')))
         capabilities.append(info['capability'])
     capabilities_cmd = 'export NOTEBOOK_BASH_KERNEL_CAPABILITIES="{}"'.format(','.join(capabilities))
     commands.append(capabilities_cmd)
     return "\n".join(commands)
 
 
+# Memory backed directory, where the contents of the display functions never touch the disk.
+_SHM_DIR = '/dev/shm'
+
+# Free space /dev/shm needs to be used. Containers often have a /dev/shm of only 64 MB, too
+# small for large contents.
+_SHM_MIN_FREE = 1 << 30
+
+# Number of bytes at the start of a file used to find its type.
+_HEADER_SIZE = 8192
+
+
+def display_dir():
+    """Returns a directory on a memory backed file system for the contents of the display
+    functions, or None to use $TMPDIR: when it is set, or there is no such directory with
+    enough free space."""
+    if 'TMPDIR' in os.environ or not os.access(_SHM_DIR, os.W_OK | os.X_OK):
+        return None
+    try:
+        stat = os.statvfs(_SHM_DIR)
+    except OSError:
+        return None
+    if stat.f_bavail * stat.f_frsize < _SHM_MIN_FREE:
+        return None
+    return _SHM_DIR
+
+
 def _unlink_if_temporary(filename):
     tmp_dir = '/tmp'
     if 'TMPDIR' in os.environ:
         tmp_dir = os.environ['TMPDIR']
-    if filename.startswith(tmp_dir):
+    if filename.startswith(tmp_dir) or filename.startswith(_SHM_DIR + '/'):
         os.unlink(filename)
 
 
-def display_data_for_image(filename):
+@contextlib.contextmanager
+def _mapped_contents(filename):
+    """Maps the contents of filename into memory, rather than reading (copying) them, and
+    unlinks the file if it is temporary."""
     with open(filename, 'rb') as f:
-        image = f.read()
-    _unlink_if_temporary(filename)
-    image_type = filetype.image_match(image).mime
-    if image_type not in ("image/png", "image/jpg", "image/gif", "image/webp"):
-        raise ValueError("Not a valid image: %s" % image)
+        _unlink_if_temporary(filename)
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty, or not a regular file (e.g. a named pipe): can't be mapped.
+            yield f.read()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+            yield contents
+
+
+# Image formats understood by the frontends, and formats images can be converted to.
+_IMAGE_TYPES = ("image/png", "image/jpg", "image/jpeg", "image/gif", "image/webp")
+_IMAGE_FORMATS = {'png': 'PNG', 'jpeg': 'JPEG', 'jpg': 'JPEG', 'webp': 'WEBP', 'gif': 'GIF'}
+
+
+def _parse_size(size):
+    """Parses "<width>x<height>", or "<size>" for a square bounding box."""
+    try:
+        if 'x' in size:
+            width, height = size.split('x', 1)
+            return int(width), int(height)
+        return int(size), int(size)
+    except ValueError:
+        raise ValueError('Invalid image size "%s", use <width>x<height>' % size)
+
+
+def _convert_image(image, max_size=None, format=None, quality=None):
+    """Downscales image to fit max_size and/or re-encodes it to format. Returns the mime
+    type, the image data and its width and height."""
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ValueError("Resizing or converting images needs Pillow: pip install Pillow")
+    img = Image.open(io.BytesIO(image))
+    save_format = img.format
+    if format is not None:
+        if format.lower() not in _IMAGE_FORMATS:
+            raise ValueError('Unsupported image format "%s", use one of: %s' % (
+                format, ', '.join(sorted(_IMAGE_FORMATS))))
+        save_format = _IMAGE_FORMATS[format.lower()]
+    if max_size is not None:
+        max_size = _parse_size(max_size)
+        # For JPEG, lets the decoder do most of the downscaling, which is much faster.
+        img.draft('RGB', max_size)
+        img.thumbnail(max_size)
+    if save_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    save_options = {}
+    if quality is not None:
+        save_options['quality'] = int(quality)
+    output = io.BytesIO()
+    img.save(output, format=save_format, **save_options)
+    return Image.MIME[save_format], output.getvalue(), img.width, img.height
+
+
+def display_data_for_image(filename, max_size=None, format=None, quality=None):
+    """Images are sent as they are, unless any of the options is given:
+
+    - max_size: "<width>x<height>" (or "<size>") the image is downscaled to fit in.
+    - format: png, jpeg, webp or gif, to re-encode the image.
+    - quality: quality setting for the encoder (e.g. 1-100 for jpeg and webp).
+
+    Converted images have their width and height in the metadata.
+    """
+    # Imported here, as it is only needed once an image is displayed.
+    import filetype
+
+    metadata = {}
+    with _mapped_contents(filename) as image:
+        # Only the header is needed to find the image type.
+        match = filetype.image_match(image[:_HEADER_SIZE])
+        image_type = match.mime if match is not None else None
+        if image_type not in _IMAGE_TYPES:
+            raise ValueError("Not a valid image: %s" % filename)
+        if max_size is None and format is None and quality is None:
+            # Images are sent base64 encoded: encode straight from the mapped file.
+            image_data = base64.b64encode(image).decode('ascii')
+        else:
+            image_type, image, width, height = _convert_image(image, max_size, format, quality)
+            image_data = base64.b64encode(image).decode('ascii')
+            metadata[image_type] = {'width': width, 'height': height}
 
     content = {
         'data': {
-            image_type: image
+            image_type: image_data
         },
-        'metadata': {}
+        'metadata': metadata
     }
     return content
 
 
 def display_data_for_html(filename):
-    with open(filename, 'rb') as f:
-        html_data = f.read()
-    _unlink_if_temporary(filename)
+    with _mapped_contents(filename) as html_data:
+        html = str(html_data, 'utf-8')
     content = {
         'data': {
-            'text/html': html_data.decode('utf-8'),
+            'text/html': html,
         },
         'metadata': {}
     }
@@ -129,17 +284,29 @@ def display_data_for_html(filename):
 
 def display_data_for_js(filename):
     """JavaScript data will all be displayed within the same display_id, to avoid creating different ones for each javascript command."""
-    with open(filename, 'rb') as f:
-        html_data = f.read()
-    _unlink_if_temporary(filename)
+    with _mapped_contents(filename) as js_data:
+        js = str(js_data, 'utf-8')
     content = {
         'data': {
-            'text/javascript': html_data.decode('utf-8'),
+            'text/javascript': js,
         },
         'metadata': {}
     }
     return content
 
+def display_data_for_table(filename, rows=None, delimiter=None):
+    """Tables are saved as a summary by table.py, which already applied the options:
+
+    - rows: number of rows shown at the start and at the end of the table.
+    - delimiter: the delimiter of the columns (a character, or tab, comma, semicolon or
+      pipe), instead of the one guessed from the header.
+    """
+    with _mapped_contents(filename) as summary_data:
+        summary = json.loads(str(summary_data, 'utf-8') or '{}')
+    if 'header' not in summary:
+        raise ValueError(summary.get('error') or 'Could not read the table: %s' % filename)
+    return table_display_data(summary)
+
 def split_lines(text):
     """Split lines on '\n' or '\r', preserving the ending (end-of-line/line-feed or carriage-return)."""
     # lines_and_endings will alternate between the line content and a line separator (end-of-line or carriage-return),
@@ -165,42 +332,94 @@ def split_lines(text):
         ii += 2  # Skip to next content+ending parts.
     return lines
 
+def _plain_text(text):
+    """Returns plain output as split_lines() would join it back: with '\\r\\n' line endings
+    turned into '\\n', and a line ending added to a trailing partial line."""
+    if '\r\n' in text:
+        text = text.replace('\r\n', '\n')
+    if text and text[-1] not in '\r\n':
+        text += '\n'
+    return text
+
+
+def iter_contents(output):
+    """Yields the plain output (as strings) and the rich content data (as dicts, or exceptions
+    if the content couldn't be read) of output, in order.
+
+    The result is the same as splitting output with split_lines() and looking for the
+    CONTENT_DATA_PREFIXES at the start of each line, but rich content is rare, so output
+    without the common prefix of the markers is passed on in one piece, and otherwise all the
+    markers are found by a single regex search."""
+    if TEXT_SAVED_PREFIX not in output:
+        if output:
+            yield _plain_text(output)
+        return
+    pos = 0
+    for match in _MARKER_RE.finditer(output):
+        if match.start() > pos:
+            yield _plain_text(output[pos:match.start()])
+        pos = match.end()
+        display_id = match.group('display_id')
+        try:
+            filename = match.group('filename')
+            if filename[:1] in ('[', '('):
+                raise ValueError('Invalid options or display_id for rich content "{}"'.format(
+                    match.group().rstrip('\r\n')))
+            info = CONTENT_DATA_PREFIXES[match.group('prefix')]
+            options = _options(match.group('options'), info)
+            content = info['display_data_fn'](filename, **options)
+        except Exception as e:
+            # Reported to the user, rather than stopping the output of the cell.
+            content = e
+            _discard(filename)
+        if display_id is not None and not isinstance(content, Exception):
+            if 'transient' not in content:
+                content['transient'] = {}
+            content['transient']['display_id'] = display_id
+        yield content
+    if pos < len(output):
+        yield _plain_text(output[pos:])
+
+
 def extract_contents(output):
     """Returns plain_output string and a list of rich content data."""
-    output_lines = []
+    plain_outputs = []
     rich_contents = []
-    for line in split_lines(output):
-        matched = False
-        for key, info in CONTENT_DATA_PREFIXES.items():
-            if line.startswith(key):
-                filename, display_id = _filename_and_display_id(line[len(key):-1])
-                content = info['display_data_fn'](filename)
-                if display_id is not None:
-                    if 'transient' not in content:
-                        content['transient'] = {}
-                    content['transient']['display_id'] = display_id
-                rich_contents.append(content)
-                matched = True
-                break
-        if not matched:
-            output_lines.append(line)
-
-    plain_output = ''.join(output_lines)
+    for content in iter_contents(output):
+        if isinstance(content, str):
+            plain_outputs.append(content)
+        else:
+            rich_contents.append(content)
+
+    plain_output = ''.join(plain_outputs)
     return plain_output, rich_contents
 
 
-def _filename_and_display_id(line):
-    """line will be either "filename" or "(display_id) filename"."""
-    if line[0] != '(':
-        return line, None
-    pos = line.find(')')
-    if pos == -1:
-        raise ValueError('Invalid filename/display_id for rich content "{}"'.format(line))
-    if line[pos+1] == ' ':
-        filename = line[pos+2:]
-    else:
-        filename = line[pos+1:]
-    return filename, line[1:pos]
+def _options(options, info):
+    """Returns the options given to a display function (e.g. `display --max-size=800x600`),
+    as "option=value ..." in the marker, as a dict. Raises ValueError for options the
+    function (described by info, from CONTENT_DATA_PREFIXES) doesn't have."""
+    if options is None:
+        return {}
+    result = {}
+    for option in options.split():
+        name, _, value = option.partition('=')
+        if name not in info['options']:
+            if info['options']:
+                raise ValueError('Unknown option --%s of %s, use one of: %s' % (
+                    name, info['display_cmd'],
+                    ', '.join('--' + known for known in info['options'])))
+            raise ValueError('%s has no options, got --%s' % (info['display_cmd'], name))
+        result[name.replace('-', '_')] = value
+    return result
+
+
+def _discard(filename):
+    """Unlinks the temporary file of content that couldn't be displayed, if still there."""
+    try:
+        _unlink_if_temporary(filename)
+    except OSError:
+        pass
 
 
 # Maps content prefixes to function that display its contents.
@@ -209,15 +428,35 @@ CONTENT_DATA_PREFIXES = {
         'display_cmd': 'display',
         'display_data_fn': display_data_for_image,
         'capability': 'image',
+        'options': ('max-size', 'format', 'quality'),
     },
     _TEXT_SAVED_HTML: {
         'display_cmd': 'displayHTML',
         'display_data_fn': display_data_for_html,
         'capability': 'html',
+        'options': (),
     },
     _TEXT_SAVED_JAVASCRIPT: {
         'display_cmd': 'displayJS',
         'display_data_fn': display_data_for_js,
         'capability': 'javascript',
+        'options': (),
+    },
+    _TEXT_SAVED_TABLE: {
+        'display_cmd': 'displayTable',
+        'display_data_fn': display_data_for_table,
+        'capability': 'table',
+        'options': ('rows', 'delimiter'),
+        'save_cmd': _TABLE_SAVE_CMD,
     }
 }
+
+
+# A line of output with the marker of rich content: the prefix, optional options and
+# display id, and the filename. Lines also start after a bare '\r', as in split_lines().
+_MARKER_RE = re.compile(
+    r'(?:^|(?<=\r))(?P<prefix>%s)'
+    r'(?:\[(?P<options>[^\]\r\n]*)\] )?'
+    r'(?:\((?P<display_id>[^)\r\n]*)\) ?)?'
+    r'(?P<filename>[^\r\n]*)(?:\r\n|\r|\n|\Z)'
+    % '|'.join(re.escape(prefix) for prefix in CONTENT_DATA_PREFIXES), re.MULTILINE)
@@ -0,0 +1,217 @@
+"""history.py keeps the history of the cells run in all sessions, in an SQLite database.
+
+The kernel answers history requests (used by e.g. jupyter console to recall earlier cells)
+from it, with the three access types of the messaging protocol:
+
+- range: the cells of a session, given as an id (0 or less is relative to the current
+  session), from line `start` up to (not including) line `stop`.
+- tail: the last `n` cells.
+- search: the last `n` cells matching a glob `pattern`, such as 'git *' or '*rsync*'.
+
+Each entry holds the session, the execution count (as its line), the code, the exit code
+of the cell (NULL if unknown, e.g. when interrupted), how long it ran, the directory it
+started in and when it ran.
+
+Cells are written by a thread of `HistoryStore`: `add()` only queues the entry, so the
+history never slows down executions. The database is in WAL mode, so reads don't wait for
+writes (but they do wait for the queued entries to be written, to see them).
+
+Searches stay fast with years of history: patterns that start with a literal, like
+'git *', are looked up in an index of the code, and other patterns in a trigram full-text
+index (FTS5, SQLite 3.34 or later), which finds substrings of 3 or more characters without
+scanning the history. Without FTS5, such searches scan the history instead.
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session INTEGER PRIMARY KEY AUTOINCREMENT,
+    start REAL
+);
+CREATE TABLE IF NOT EXISTS history (
+    session INTEGER,
+    line INTEGER,
+    code TEXT,
+    exit_code INTEGER,
+    duration REAL,
+    cwd TEXT,
+    time REAL,
+    PRIMARY KEY (session, line)
+);
+CREATE INDEX IF NOT EXISTS history_code ON history (code);
+"""
+
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5 (
+    code, content='history', content_rowid='rowid', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+    INSERT INTO history_fts (rowid, code) VALUES (new.rowid, new.code);
+END;
+CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+    INSERT INTO history_fts (history_fts, rowid, code) VALUES ('delete', old.rowid, old.code);
+END;
+"""
+
+# Characters with a special meaning in glob patterns.
+_GLOB_CHARS = '*?['
+
+
+class HistoryStore:
+    """The history database in filename (':memory:' for a history of this session only).
+
+    :param log: a logger for errors opening or writing the database.
+    """
+    def __init__(self, filename, log=None):
+        self.filename = filename
+        self.log = log
+        # The id of the current session, once the database is open.
+        self.session = None
+        self._uri = False
+        if filename == ':memory:':
+            # Shared between the connections of the writer and of the readers.
+            self.filename = ('file:bash_kernel_history_%s?mode=memory&cache=shared'
+                             % uuid.uuid4().hex)
+            self._uri = True
+        self._fts = False
+        self._queue = queue.Queue()
+        self._ready = threading.Event()
+        self._reader = None
+        self._reader_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, uri=self._uri, check_same_thread=False)
+
+    def _open(self):
+        if not self._uri:
+            directory = os.path.dirname(self.filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        connection = self._connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        # INSERT OR REPLACE only runs the delete trigger of the full-text index with it.
+        connection.execute('PRAGMA recursive_triggers=ON')
+        connection.executescript(_SCHEMA)
+        try:
+            connection.executescript(_FTS_SCHEMA)
+            self._fts = True
+        except sqlite3.OperationalError:
+            # No FTS5, or no trigram tokenizer.
+            pass
+        with connection:
+            self.session = connection.execute('INSERT INTO sessions (start) VALUES (?)',
+                                              (time.time(),)).lastrowid
+        return connection
+
+    def _write(self):
+        try:
+            connection = self._open()
+        except (OSError, sqlite3.Error) as e:
+            connection = None
+            if self.log is not None:
+                self.log.warning("Could not open the history database %s: %s", self.filename, e)
+        self._ready.set()
+        while True:
+            entries = [self._queue.get()]
+            # Write what queued up meanwhile in the same transaction.
+            while True:
+                try:
+                    entries.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in entries
+            entries = [entry for entry in entries if entry is not None]
+            if connection is not None and entries:
+                try:
+                    self._insert(connection, entries)
+                except Exception:
+                    # Write the entries one by one, so that a bad one doesn't lose the
+                    # others.
+                    for entry in entries:
+                        try:
+                            self._insert(connection, [entry])
+                        except Exception as e:
+                            # The thread must go on, or queries would wait forever.
+                            if self.log is not None:
+                                self.log.warning("Could not write to the history database: %s",
+                                                 e)
+            for _ in range(len(entries) + closing):
+                self._queue.task_done()
+            if closing:
+                if connection is not None:
+                    connection.close()
+                return
+
+    def _insert(self, connection, entries):
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   [(self.session,) + entry for entry in entries])
+
+    def add(self, line, code, exit_code, duration, cwd, timestamp=None):
+        """Queues a cell to be written to the history."""
+        # Lone surrogates (e.g. "\ud800" in the JSON of a request, or undecodable bytes in
+        # a directory name) can't be stored.
+        code = code.encode('utf-8', 'replace').decode('utf-8')
+        cwd = cwd.encode('utf-8', 'replace').decode('utf-8')
+        self._queue.put((line, code, exit_code, duration, cwd,
+                         time.time() if timestamp is None else timestamp))
+
+    def close(self):
+        """Writes the queued cells and closes the database."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def _query(self, sql, parameters):
+        """Returns the rows of a query, once all the queued cells are written."""
+        self._ready.wait()
+        self._queue.join()
+        if self.session is None:
+            return []
+        with self._reader_lock:
+            if self._reader is None:
+                self._reader = self._connect()
+            return self._reader.execute(sql, parameters).fetchall()
+
+    def get_range(self, session=0, start=1, stop=None):
+        """Returns (session, line, code) of the cells of a session from line start to stop."""
+        self._ready.wait()
+        if session is None or session <= 0:
+            session = (self.session or 0) + (session or 0)
+        sql = 'SELECT session, line, code FROM history WHERE session = ? AND line >= ?'
+        parameters = [session, start or 0]
+        if stop:
+            sql += ' AND line < ?'
+            parameters.append(stop)
+        return self._query(sql + ' ORDER BY line', parameters)
+
+    def get_tail(self, n=10):
+        """Returns (session, line, code) of the last n cells, oldest first."""
+        rows = self._query('SELECT session, line, code FROM history ORDER BY rowid DESC LIMIT ?',
+                           [n if n is not None else -1])
+        return rows[::-1]
+
+    def search(self, pattern='*', n=None, unique=False):
+        """Returns (session, line, code) of the last n cells whose code matches the glob
+        pattern, oldest first. With unique, only the last cell with the same code is kept."""
+        if not pattern or pattern[0] not in _GLOB_CHARS or not self._fts:
+            matches = 'SELECT rowid FROM history WHERE code GLOB ?'
+        else:
+            matches = 'SELECT rowid FROM history_fts WHERE code GLOB ?'
+        if unique:
+            matches = 'SELECT MAX(rowid) FROM history WHERE rowid IN (%s) GROUP BY code' % matches
+        rows = self._query('SELECT session, line, code FROM history WHERE rowid IN (%s) '
+                           'ORDER BY rowid DESC LIMIT ?' % matches,
+                           [pattern, n if n is not None else -1])
+        return rows[::-1]
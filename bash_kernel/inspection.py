@@ -0,0 +1,63 @@
+"""inspection.py answers inspect requests (shift-tab in the notebook) about the word under
+the cursor.
+
+The kernel asks bash for `type -a` of the word, and the `help` of builtins and keywords,
+with the `__bash_kernel_inspect` function defined by `build_cmds()`. The answer only changes
+when the commands of the session do, so `InspectionCache` keeps it per name until $PATH or
+the definitions of the functions, aliases and exported variables of the session change (as
+seen in the state read by state.py).
+"""
+import re
+
+
+_INSPECT_CMD = """
+__bash_kernel_inspect () {
+    local __bk_type
+    __bk_type=$(type -t -- "$1") || return 1
+    type -a -- "$1"
+    if [[ $__bk_type == builtin || $__bk_type == keyword ]]; then
+        echo
+        help -- "$1"
+    fi
+}
+"""
+
+# Characters that are not part of a command name.
+_NAME_RE = re.compile(r'''[^\s;&|<>()'"`$=]*''')
+
+
+def build_cmds():
+    return _INSPECT_CMD
+
+
+def word_at(code, cursor_pos):
+    """Returns the command name around cursor_pos in code, or '' if there is none."""
+    start = cursor_pos
+    while start > 0 and _NAME_RE.fullmatch(code[start - 1]):
+        start -= 1
+    if start > 0 and code[start - 1] in '$=':
+        # A variable, or the value of an assignment.
+        return ''
+    return _NAME_RE.match(code, start).group()
+
+
+class InspectionCache:
+    """Inspection results per name, for as long as the commands of the session don't change."""
+    def __init__(self):
+        self._key = None
+        self._results = {}
+
+    def update(self, state):
+        """Forgets all results if the commands of the session may have changed."""
+        if state is None:
+            return
+        key = (state['path'], state['definitions'])
+        if key != self._key:
+            self._key = key
+            self._results = {}
+
+    def get(self, name):
+        return self._results.get(name)
+
+    def set(self, name, result):
+        self._results[name] = result
@@ -1,36 +1,86 @@
 from ipykernel.kernelbase import Kernel
-from pexpect import replwrap, EOF
+from pexpect import replwrap, EOF, TIMEOUT
 import pexpect
 
-from subprocess import check_output
+import asyncio
+import collections
+import hashlib
+import inspect
 import os.path
 import uuid
 import random
 import string
+import time
 
 import re
+import shlex
+import shutil
 import signal
+import tempfile
+import threading
+
+from jupyter_core.paths import jupyter_data_dir
+from traitlets import Bool, Float, Integer, Unicode
 
 __version__ = '0.10.0'
 
 version_pat = re.compile(r'version (\d+(\.\d+)+)')
 
-from .display import (extract_contents, build_cmds)
+from .display import (iter_contents, build_cmds, display_dir, TEXT_SAVED_PREFIX)
+from .completion import build_cmds as build_completion_cmds, parse_completions
+from .state import (build_cmds as build_state_cmds, read_state, checkpoint_key, write_snapshot,
+                    CommandIndex)
+from .metrics import ExecutionMetrics, log_metrics
+from .syntax import is_complete
+from .inspection import build_cmds as build_inspect_cmds, word_at, InspectionCache
+from .profiling import (build_cmds as build_profiling_cmds, strip_profile_magic, wrap_code,
+                        read_profile, profile_display_data)
+from .output import OutputCoalescer, OutputBudget, TextDisplay
+from .parallel import strip_parallel_magic, ParallelJob, WorkerPool
+from .history import HistoryStore
+from .binary import FilteringSpawn
+from .limits import (build_cmds as build_limits_cmds, strip_limits_magic, parse_size,
+                     apply_limits, restore_limits, cpu_time, wrap_code as wrap_limits_code,
+                     command_killed, TimeLimitExceeded, CPUTimeLimitExceeded,
+                     CPU_LIMIT_EXIT_CODE, STOP_CMD as LIMITS_STOP_CMD)
 
 class IREPLWrapper(replwrap.REPLWrapper):
     """A subclass of REPLWrapper that gives incremental output
     specifically for bash_kernel.
 
-    The parameters are the same as for REPLWrapper, except for one
-    extra parameter:
+    The parameters are the same as for REPLWrapper, except for a few
+    extra parameters:
 
     :param line_output_callback: a callback method to receive each batch
       of incremental output. It takes one string parameter.
+    :param idle_callback: an optional callback method, called without
+      parameters whenever no output arrived for `idle_timeout` seconds while
+      waiting for incremental output.
+
+    PS1 must show the exit code of the last command right before its final
+    ">": it is made available as `exit_code` whenever PS1 is found.
+
+    While output is read incrementally, another thread can set
+    `interrupt_requested` to raise KeyboardInterrupt in the reading thread,
+    as a SIGINT would in the main thread. Past `deadline` (a time.monotonic()
+    value, if set), TimeLimitExceeded is raised instead, and CPUTimeLimitExceeded
+    once the CPU time of the child reaches `cpu_deadline` (in seconds, if set).
     """
+    # Minimum time, in seconds, between two checks of the CPU time of the child.
+    cpu_check_interval = 0.25
+
+    # Maximum number of characters read from the child at once.
+    read_chunk_size = 65536
+    # Lines longer than this are passed on to line_output_callback in pieces.
+    max_line_length = 65536
+
     def __init__(self, cmd_or_spawn, orig_prompt, prompt_change, unique_prompt,
-                 extra_init_cmd=None, line_output_callback=None):
+                 extra_init_cmd=None, line_output_callback=None,
+                 idle_callback=None, idle_timeout=None):
         self.unique_prompt = unique_prompt
         self.line_output_callback = line_output_callback
+        self.idle_callback = idle_callback
+        self.idle_timeout = idle_timeout
         # The extra regex at the start of PS1 below is designed to catch the
         # `(envname) ` which conda/mamba add to the start of PS1 by default.
         # Obviously anything else that looks like this, including user output,
@@ -40,40 +90,155 @@ class IREPLWrapper(replwrap.REPLWrapper):
         # probably no, as we never see individual commands but rather cells
         # with possibly many commands, and would need to update this half-way
         # through a cell.
-        self.ps1_re = r"(\(\w+\) )?" + re.escape(self.unique_prompt + ">")
+        self.ps1_re = r"(\(\w+\) )?" + re.escape(self.unique_prompt) + r"(?P<exit_code>\d+)>"
         self.ps2_re = re.escape(self.unique_prompt + "+")
+        self._prompt_patterns = [re.compile(self.ps1_re), re.compile(self.ps2_re)]
+        # Both prompts in a single regex, to look for them in the output of cells.
+        self._prompt_re = re.compile('(?P<ps1>%s)|(?P<ps2>%s)' % (self.ps1_re, self.ps2_re))
+        # How far back from the end of the output a prompt may start (allowing
+        # for the conda environment name).
+        self._prompt_lookback = len(self.unique_prompt) + 256
+        self.exit_code = None
+        self.interrupt_requested = False
+        self.deadline = None
+        self.cpu_deadline = None
+        self._next_cpu_check = 0
         replwrap.REPLWrapper.__init__(self, cmd_or_spawn, orig_prompt,
                 prompt_change, new_prompt=self.ps1_re,
                 continuation_prompt=self.ps2_re, extra_init_cmd=extra_init_cmd)
 
     def _expect_prompt(self, timeout=-1):
-        prompts = [self.ps1_re, self.ps2_re]
-
         if timeout == None:
             # "None" means we are executing code from a Jupyter cell by way of the run_command
-            # in the do_execute() code below, so do incremental output, i.e.
-            # also look for end of line or carridge return
-            prompts.extend(['\r?\n', '\r'])
-            while True:
-                pos = self.child.expect_list([re.compile(x) for x in prompts], timeout=None)
-                if pos == 2:
-                    # End of line received.
-                    self.line_output_callback(self.child.before + '\n')
-                elif pos == 3:
-                    # Carriage return ('\r') received.
-                    self.line_output_callback(self.child.before + '\r')
-                else:
-                    if len(self.child.before) != 0:
-                        # Prompt received, but partial line precedes it.
-                        self.line_output_callback(self.child.before)
-                    break
+            # in the do_execute() code below, so do incremental output.
+            pos = self._read_until_prompt()
         else:
             # Otherwise, wait (with timeout) until the next prompt
-            pos = self.child.expect_list([re.compile(x) for x in prompts], timeout=timeout)
+            pos = self.child.expect_list(self._prompt_patterns, timeout=timeout)
 
-        # Prompt received, so return normally
+        if pos == 0:
+            # The exit code of the last command is part of PS1.
+            self.exit_code = int(self.child.match.group('exit_code'))
         return pos
 
+    def _search_prompt(self, text, start):
+        """Returns the match of the first PS1 or PS2 prompt in text[start:], or None."""
+        # Looking for the fixed part of the prompts first is much faster than a regex search.
+        pos = text.find(self.unique_prompt, start)
+        while pos != -1:
+            match = self._prompt_re.search(text, max(start, pos - self._prompt_lookback))
+            if match is not None:
+                return match
+            pos = text.find(self.unique_prompt, pos + 1)
+        return None
+
+    def _read_until_prompt(self):
+        """Reads the output of the child in large chunks, passing on complete lines
+        to line_output_callback, until a prompt is found.
+
+        Returns 0 for the PS1 prompt or 1 for the PS2 (continuation) prompt, like
+        _expect_prompt. `child.before` is set to the output since the last complete
+        line passed on, and the output following the prompt is left in `child.buffer`.
+        """
+        child = self.child
+        # Output read from the child, but not yet passed on to line_output_callback.
+        pending = child.buffer
+        child.buffer = child.string_type()
+        searched = 0
+        try:
+            while True:
+                # Only the end of the previously searched output could hold the start of a
+                # prompt, so long lines without a line ending are not searched again.
+                match = self._search_prompt(pending, max(0, searched - self._prompt_lookback))
+                if match is not None:
+                    break
+                if self.interrupt_requested:
+                    self.interrupt_requested = False
+                    raise KeyboardInterrupt
+                if self.deadline is not None and time.monotonic() >= self.deadline:
+                    self.deadline = None
+                    raise TimeLimitExceeded
+                if self.cpu_deadline is not None and time.monotonic() >= self._next_cpu_check:
+                    self._next_cpu_check = time.monotonic() + self.cpu_check_interval
+                    if cpu_time(child.pid) >= self.cpu_deadline:
+                        self.cpu_deadline = None
+                        raise CPUTimeLimitExceeded
+                # Pass on all complete lines. A trailing '\r' may be the start of a
+                # '\r\n' that is split across reads, so it is kept for now.
+                end = max(pending.rfind('\n'), pending.rfind('\r', 0, len(pending) - 1)) + 1
+                if len(pending) - end > self.max_line_length:
+                    # Very long line: pass it on in pieces to bound memory use.
+                    end = len(pending) - self._prompt_lookback
+                if end > 0:
+                    output, pending = pending[:end], pending[end:]
+                    self.line_output_callback(output.replace('\r\n', '\n'))
+                searched = len(pending)
+                try:
+                    pending += child.read_nonblocking(self.read_chunk_size, self.idle_timeout)
+                except TIMEOUT:
+                    if pending.endswith('\r'):
+                        # No more output followed the carriage return, so it is not
+                        # part of '\r\n', and the progress bar update can be shown.
+                        output, pending = pending, ''
+                        self.line_output_callback(output.replace('\r\n', '\n'))
+                    if self.idle_callback is not None:
+                        # No output for a while, let the callback send what it has pending.
+                        self.idle_callback()
+        except EOF:
+            # Keep the output read so far available, as expect() does.
+            child.before = pending
+            raise
+        except (KeyboardInterrupt, TimeLimitExceeded):
+            # Put the output read so far back, for the _expect_prompt() following the interrupt.
+            child.buffer = pending
+            raise
+
+        before = pending[:match.start()]
+        if before:
+            before = before.replace('\r\n', '\n')
+            if before[-1] not in '\r\n':
+                # Prompt received, but partial line precedes it: terminate
+                # it, so that it is not joined with the output that follows.
+                before += '\n'
+            self.line_output_callback(before)
+        child.before = pending[:match.start()]
+        child.after = match.group()
+        child.match = match
+        child.buffer = pending[match.end():]
+        return 0 if match.group('ps1') is not None else 1
+
+def _reset_signal_handlers():
+    # Ignored signals stay ignored in exec'd processes. Since kernelapp ignores
+    # SIGINT except in message handlers, we need to reset the SIGINT handler in
+    # bash so that bash and its children are interruptible. This runs in the
+    # forked child, as the kernel may be spawning bash from another thread than
+    # the main one, where signal handlers can't be changed.
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # We need to reset the default signal handler for SIGPIPE so that commands
+    # like `head` used in a pipe chain can signal to the data producers.
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+# Requests answered while a cell is running.
+_CONCURRENT_REQUESTS = {'complete_request', 'inspect_request', 'is_complete_request',
+                        'kernel_info_request'}
+
+# Whether ipykernel can dispatch a request while another one is handled (ipykernel 7
+# internals, see BashKernel.shell_main()). Without it, requests wait for the running cell.
+_CONCURRENT_DISPATCH = ('concurrent' in inspect.signature(Kernel.dispatch_shell).parameters
+                        and hasattr(Kernel, '_get_shell_context_var'))
+
+
+def _content_digest(content):
+    """Returns a digest of the data and metadata of rich content, to detect identical updates."""
+    digest = hashlib.sha1()
+    for mime_type, data in sorted(content['data'].items()):
+        digest.update(mime_type.encode('utf-8'))
+        digest.update(data.encode('utf-8') if isinstance(data, str) else data)
+    digest.update(repr(content.get('metadata')).encode('utf-8'))
+    return digest.digest()
+
+
 class BashKernel(Kernel):
     implementation = 'bash_kernel'
     implementation_version = __version__
@@ -83,166 +248,733 @@ class BashKernel(Kernel):
         m = version_pat.search(self.banner)
         return m.group(1)
 
-    _banner = None
-
     @property
     def banner(self):
-        if self._banner is None:
-            self._banner = check_output(['bash', '--version']).decode('utf-8')
-        return self._banner
+        return 'GNU bash, version %s' % self._bash_version
 
     language_info = {'name': 'bash',
                      'codemirror_mode': 'shell',
                      'mimetype': 'text/x-sh',
                      'file_extension': '.sh'}
 
+    output_flush_interval = Float(0.05, help="""Maximum time, in seconds, that
+        output of a running cell is held back to be sent together with
+        the output that follows it.""").tag(config=True)
+
+    output_flush_size = Integer(65536, help="""Number of characters of output
+        after which the pending output of a running cell is sent
+        immediately.""").tag(config=True)
+
+    output_limit = Integer(0, help="""Maximum number of characters of output
+        of a cell sent to the frontend. Output past this limit is saved to
+        a file instead, and a summary is shown at the end of the cell. 0
+        means no limit.""").tag(config=True)
+
+    max_display_ids = Integer(1000, help="""Maximum number of display ids
+        whose contents are remembered within an execution. Past this, the
+        least recently updated ones are displayed anew on their next
+        update.""").tag(config=True)
+
+    table_rows = Integer(10, help="""Number of rows displayTable shows at the
+        start and at the end of a table, unless given with --rows.""").tag(config=True)
+
+    metrics_log = Unicode('', help="""File to append the metrics of each
+        execution to, as JSON lines. The metrics are also in the metadata of
+        every execute_reply.""").tag(config=True)
+
+    history_file = Unicode('', help="""SQLite database the history of the cells
+        run in all sessions is saved to, for history requests (e.g. from
+        jupyter console). By default, bash_kernel/history.sqlite in the
+        Jupyter data directory. ':memory:' keeps the history of this session
+        only.""").tag(config=True)
+
+    max_completions = Integer(1000, help="""Maximum number of completion
+        candidates of each kind (files, commands, ...) requested from bash.""").tag(config=True)
+
+    profile_cells = Bool(False, help="""Profile every cell, as if it started
+        with a %%profile line: time each command of the cell and show the
+        slowest ones in a table after its output.""").tag(config=True)
+
+    restore_state = Bool(True, help="""When bash exits, restore the working
+        directory, exported variables, functions and aliases of the last
+        successful cell in the new bash.""").tag(config=True)
+
+    snapshot_file = Unicode('', help="""File to save the state of the session
+        to, to restore it after bash exits. If the file exists when the kernel
+        starts, the state is restored from it, so it also survives kernel
+        restarts. By default, a file in a temporary directory of the kernel is
+        used.""").tag(config=True)
+
+    parallel_workers = Integer(4, help="""Maximum number of worker bash
+        processes running %%parallel cells at the same time.""").tag(config=True)
+
+    background_output = Bool(True, help="""Show the output background jobs write
+        while no cell is running in a display of the last cell that started
+        background jobs, instead of in the next cell.""").tag(config=True)
+
+    cell_time_limit = Float(0, help="""Maximum wall-clock time, in seconds, a
+        cell may run for. Past it, the cell is interrupted, and killed if it
+        doesn't stop within interrupt_grace seconds. 0 means no limit. Cells
+        can set their own limit with a `%%limits time=<seconds>` line.""").tag(config=True)
+
+    cell_cpu_limit = Float(0, help="""Maximum CPU time, in seconds, each process
+        started by a cell may use (the soft `ulimit -t`). 0 means no limit.
+        Cells can set their own limit with a `%%limits cpu=<seconds>`
+        line. Needs Linux.""").tag(config=True)
+
+    cell_memory_limit = Unicode('', help="""Maximum memory (address space) each
+        process started by a cell may use, e.g. '4G' (the soft `ulimit -v`).
+        Empty means no limit. Cells can set their own limit with a
+        `%%limits memory=<size>` line. Needs Linux.""").tag(config=True)
+
+    interrupt_grace = Float(5, help="""Time, in seconds, a cell past its time
+        limit has to stop after being interrupted, before its processes are
+        killed.""").tag(config=True)
+
+    sidecar_bash = Bool(False, help="""Start a second bash in the background
+        when the kernel starts, to answer completion and inspection requests
+        while cells run. It reads ~/.bashrc too, so anything this does, it does
+        twice. Needs ipykernel 7 or later.""").tag(config=True)
+
+    standby_bash = Bool(False, help="""Keep a second bash started in the
+        background, to take over right away when bash exits, instead of
+        waiting for a new bash to read its startup files.""").tag(config=True)
+
     def __init__(self, **kwargs):
+        self._created = time.perf_counter()
         # Make a random prompt, further reducing chances of accidental matches.
         rand = ''.join(random.choices(string.ascii_uppercase, k=12))
         self.unique_prompt = "PROMPT_" + rand
         Kernel.__init__(self, **kwargs)
-        self._start_bash()
-        self._known_display_ids = set()
-
-    def _start_bash(self):
-        # Signal handlers are inherited by forked processes, and we can't easily
-        # reset it from the subprocess. Since kernelapp ignores SIGINT except in
-        # message handlers, we need to temporarily reset the SIGINT handler here
-        # so that bash and its children are interruptible.
-        old_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_DFL)
-        # We need to temporarily reset the default signal handler for SIGPIPE so
-        # that commands like `head` used in a pipe chain can signal to the data
-        # producers. 
-        old_sigpipe_handler = signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        self._metrics = ExecutionMetrics()
+        self._history = HistoryStore(
+            self.history_file or os.path.join(jupyter_data_dir(), 'bash_kernel', 'history.sqlite'),
+            log=self.log)
+        # Exit code of the last cell run by the main bash, None if unknown (see _execute).
+        self._exit_code = None
+        self._output_budget = OutputBudget(self.process_output, limit=self.output_limit,
+                                           keep_prefix=TEXT_SAVED_PREFIX)
+        self._output = OutputCoalescer(self._output_budget.write,
+                                       flush_interval=self.output_flush_interval,
+                                       flush_size=self.output_flush_size)
+        # Directory for the files the kernel shares with bash.
+        self._tmpdir = tempfile.mkdtemp(prefix='bash_kernel.')
+        self._state_file = os.path.join(self._tmpdir, 'state')
+        self._profile_file = os.path.join(self._tmpdir, 'profile')
+        self._cpu_marker_file = os.path.join(self._tmpdir, 'cpu_limit_exceeded')
+        self._snapshot_file = self.snapshot_file or os.path.join(self._tmpdir, 'snapshot')
+        self._shell_state = None
+        self._command_index = CommandIndex()
+        self._inspection_cache = InspectionCache()
+        # checkpoint_key() of the state in the last snapshot.
+        self._checkpoint_key = None
+        self._start_bash(restore=bool(self.snapshot_file))
+        self._standby = self._spawn_bash() if self.standby_bash else None
+        # Whether a cell is running. Introspection requests are then answered using the
+        # sidecar bash, which is set up in the background, and only used once it is ready.
+        self._busy = False
+        # Guards the sidecar bash from being published after the kernel shut down.
+        self._sidecar_lock = threading.Lock()
+        self._shut_down = False
+        self._sidecar_child = None
+        self._sidecar = None
+        self._sidecar_location = None
+        if self.sidecar_bash and _CONCURRENT_DISPATCH:
+            threading.Thread(target=self._start_sidecar, daemon=True).start()
+        # Runs %%parallel cells, created when the first one runs.
+        self._parallel = None
+        # The display of the last cell that started background jobs, the process ids of the
+        # jobs running after the last cell, and the event loop reading their output while
+        # no cell runs (see _watch_background_jobs).
+        self._background = None
+        self._background_jobs = frozenset()
+        self._background_loop = None
+        self._background_flush = None
+        if self.log is not None:
+            self.log.info("Bash %s started in %.3f s", self._bash_version,
+                          time.perf_counter() - self._created)
+        # Set by the first execution, see do_execute().
+        self.time_to_first_execute = None
+        # Maps the display ids of the current execution to the digest of their contents,
+        # least recently updated first.
+        self._known_display_ids = collections.OrderedDict()
+
+    def _spawn_bash(self):
+        # Note: the next few lines mirror functionality in the
+        # bash() function of pexpect/replwrap.py.  Look at the
+        # source code there for comments and context for
+        # understanding the code here.
+        bashrc = os.path.join(os.path.dirname(pexpect.__file__), 'bashrc.sh')
+        # The output of bash is decoded with binary data summarized, see binary.py.
+        return FilteringSpawn("bash", ['--rcfile', bashrc], prompt=self.unique_prompt,
+                              echo=False, preexec_fn=_reset_signal_handlers)
+
+    def _wrap_bash(self, child, line_output_callback=None, idle_callback=None):
+        """Returns the IREPLWrapper of a spawned bash, once its prompt is set. Its output
+        goes to the cell running in the main bash, unless other callbacks are given."""
+        # Following comment stolen from upstream's REPLWrap:
+        # If the user runs 'env', the value of PS1 will be in the output. To avoid
+        # replwrap seeing that as the next prompt, we'll embed the marker characters
+        # for invisible characters in the prompt; these show up when inspecting the
+        # environment variable, but not when bash displays the prompt.
+        # PS1 also shows the exit code of the last command, which saves a
+        # round-trip to bash to get it after every execution.
+        ps1 = self.unique_prompt + u'\[\]' + "$?>"
+        ps2 = self.unique_prompt + u'\[\]' + "+"
+        prompt_change = u"PS1='{0}' PS2='{1}' PROMPT_COMMAND=''".format(ps1, ps2)
+        # Using IREPLWrapper to get incremental output
+        return IREPLWrapper(child, u'\$', prompt_change, self.unique_prompt,
+                            line_output_callback=line_output_callback or self._output_received,
+                            idle_callback=idle_callback or self._output.flush,
+                            idle_timeout=self.output_flush_interval)
+
+    def _start_bash(self, child=None, restore=False):
+        """Sets up bash (a new one, unless child is given) for the kernel, restoring the
+        last snapshot of the session state if restore is true. Returns whether it did."""
+        if child is None:
+            child = self._spawn_bash()
+        # pexpect waits a little before each send, in case the child turns off echo
+        # after a prompt. Bash doesn't, so skip that wait during the setup.
+        delaybeforesend, child.delaybeforesend = child.delaybeforesend, None
+        self.bashwrapper = self._wrap_bash(child)
+
+        # The rest of the setup is sourced from a file, in a single round-trip to bash.
+        init_file = os.path.join(self._tmpdir, 'init.sh')
+        with open(init_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join([
+                "export PAGER=cat",
+                # Disable bracketed paste (see <https://github.com/takluyver/bash_kernel/issues/117>)
+                "bind 'set enable-bracketed-paste off' >/dev/null 2>&1 || true",
+                # Register Bash function to write image data to temporary file
+                build_cmds(display_dir(), self.table_rows),
+                # Register Bash functions used for tab completion
+                build_completion_cmds(),
+                # Keep track of the directory, $PATH, functions etc. of the session
+                build_state_cmds(self._state_file),
+                # Register Bash functions used to profile cells
+                build_profiling_cmds(),
+                # Keep bash alive past the CPU time limit of cells
+                build_limits_cmds(self._cpu_marker_file),
+                # Register Bash function used to inspect commands
+                build_inspect_cmds(),
+                # The version of the running bash, for the banner
+                'printf "%s\\n" "$BASH_VERSION"',
+            ]))
+        setup = 'source %s' % shlex.quote(init_file)
+        restore = restore and os.path.exists(self._snapshot_file)
+        if restore:
+            # Restored first, so that the kernel's own functions are those of init.sh.
+            # Errors are expected, e.g. for readonly variables.
+            setup = 'source %s >/dev/null 2>&1; %s' % (shlex.quote(self._snapshot_file), setup)
+        output = self.bashwrapper.run_command(setup)
+        self._bash_version = output.strip().rpartition('\n')[2]
+        child.delaybeforesend = delaybeforesend
+        self._update_state()
+        return restore
+
+    def _restart_bash(self):
+        """Replaces bash after it exited. Returns whether the session state was restored."""
+        child, self._standby = self._standby, None
+        if child is not None and not child.isalive():
+            child = None
+        restored = self._start_bash(child, restore=self.restore_state)
+        if self.standby_bash:
+            self._standby = self._spawn_bash()
+        return restored
+
+    def _start_worker_bash(self, line_output_callback, idle_callback):
+        wrapper = self._wrap_bash(self._spawn_bash(), line_output_callback, idle_callback)
+        wrapper.run_command("export PAGER=cat; "
+                            "bind 'set enable-bracketed-paste off' >/dev/null 2>&1 || true")
+        return wrapper
+
+    def _run_parallel(self, code, silent):
+        """Queues code to run in a worker bash, with the state of the main bash."""
+        if self._parallel is None:
+            self._parallel = WorkerPool(self._start_worker_bash, self.parallel_workers)
+        snapshot_file = os.path.join(self._tmpdir, 'parallel-%s.sh' % uuid.uuid4().hex)
+        if self._shell_state is not None:
+            # The main bash is idle, so its state is that of its last prompt.
+            write_snapshot(self._shell_state, snapshot_file)
+        self._parallel.submit(ParallelJob(code, snapshot_file, self._iopub_sender(silent),
+                                          update_interval=self.output_flush_interval))
+        return {'status': 'ok', 'execution_count': self.execution_count,
+                'payload': [], 'user_expressions': {}}
+
+    def _stop_cell(self):
+        """Stops the running cell: interrupts it, and if it doesn't stop within
+        interrupt_grace seconds, kills its foreground processes and bash, so that the rest
+        of the cell doesn't run either. Returns whether bash is still running."""
+        child = self.bashwrapper.child
         try:
-            # Note: the next few lines mirror functionality in the
-            # bash() function of pexpect/replwrap.py.  Look at the
-            # source code there for comments and context for
-            # understanding the code here.
-            bashrc = os.path.join(os.path.dirname(pexpect.__file__), 'bashrc.sh')
-            child = pexpect.spawn("bash", ['--rcfile', bashrc], echo=False,
-                                  encoding='utf-8', codec_errors='replace')
-            # Following comment stolen from upstream's REPLWrap:
-            # If the user runs 'env', the value of PS1 will be in the output. To avoid
-            # replwrap seeing that as the next prompt, we'll embed the marker characters
-            # for invisible characters in the prompt; these show up when inspecting the
-            # environment variable, but not when bash displays the prompt.
-            ps1 = self.unique_prompt + u'\[\]' + ">"
-            ps2 = self.unique_prompt + u'\[\]' + "+"
-            prompt_change = u"PS1='{0}' PS2='{1}' PROMPT_COMMAND=''".format(ps1, ps2)
-            # Using IREPLWrapper to get incremental output
-            self.bashwrapper = IREPLWrapper(child, u'\$', prompt_change, self.unique_prompt,
-                                            extra_init_cmd="export PAGER=cat",
-                                            line_output_callback=self.process_output)
-        finally:
-            signal.signal(signal.SIGINT, old_sigint_handler)
-            signal.signal(signal.SIGPIPE, old_sigpipe_handler)
+            child.sendintr()
+            self.bashwrapper._expect_prompt(timeout=self.interrupt_grace)
+            return True
+        except EOF:
+            return False
+        except TIMEOUT:
+            pass
+        try:
+            # Each pipeline runs in its own process group, the terminal's foreground one.
+            pgrp = os.tcgetpgrp(child.child_fd)
+        except OSError:
+            pgrp = child.pid
+        if pgrp != child.pid:
+            try:
+                os.killpg(pgrp, signal.SIGKILL)
+            except OSError:
+                pass
+        child.close(force=True)
+        return False
 
-        # Disable bracketed paste (see <https://github.com/takluyver/bash_kernel/issues/117>)
-        self.bashwrapper.run_command("bind 'set enable-bracketed-paste off' >/dev/null 2>&1 || true")
-        # Register Bash function to write image data to temporary file
-        self.bashwrapper.run_command(build_cmds())
+    def _restart_after_exit(self):
+        """Starts a new bash after the one running the cell exited or was killed."""
+        self._stopped_output(self.bashwrapper.child.before)
+        message = 'Restarting Bash\n'
+        if self._restart_bash():
+            message += ('Restored the working directory, exported variables, functions '
+                        'and aliases of the last successful cell\n')
+        self.process_output(message)
 
+    def _stopped_output(self, output):
+        """Passes on the output of a stopped cell that was read with `expect()`, rather
+        than passed on as it came, like the rest of it."""
+        if output:
+            self._output_received(output.replace('\r\n', '\n'))
+            self._output.flush()
 
-    def process_output(self, output):
-        if not self.silent:
-            plain_output, rich_contents = extract_contents(output)
+    def _cell_limits(self, limits):
+        """Returns the time, CPU time and memory limits of a cell, given those it sets."""
+        memory = parse_size(self.cell_memory_limit) if self.cell_memory_limit else 0
+        return (limits.get('time', self.cell_time_limit), limits.get('cpu', self.cell_cpu_limit),
+                limits.get('memory', memory))
 
-            # Send standard output
-            if plain_output:
-                stream_content = {'name': 'stdout', 'text': plain_output}
-                self.send_response(self.iopub_socket, 'stream', stream_content)
+    def _error_reply(self, ename, evalue):
+        """Sends an error, and returns the execute reply reporting it."""
+        error_content = {
+            'ename': ename,
+            'evalue': evalue,
+            'traceback': []
+        }
+        self.send_response(self.iopub_socket, 'error', error_content)
+        error_content['execution_count'] = self.execution_count
+        error_content['status'] = 'error'
+        return error_content
+
+    def _iopub_sender(self, silent=False):
+        """Returns a callback sending iopub messages (given their type and content) for the
+        current execution, even after it finished."""
+        parent = self.get_parent('shell')
+
+        def send(msg_type, content):
+            # The parent is given explicitly, as the execution may have finished.
+            if not silent:
+                self.session.send(self.iopub_socket, msg_type, content, parent=parent,
+                                  ident=self._topic(msg_type))
+        return send
+
+    def _watch_background_jobs(self, silent):
+        """Reads the output of the background jobs still running after a cell, until the
+        next cell runs, and shows it in a display of the last cell that started some.
+
+        Bash writes the output of all jobs to the same terminal, so what background jobs
+        write while a cell runs is part of that cell's output.
+        """
+        jobs = frozenset(self._shell_state['jobs']) if self._shell_state else frozenset()
+        if not jobs:
+            self._background = None
+        elif not jobs <= self._background_jobs and not silent:
+            self._background = TextDisplay(self._iopub_sender(),
+                                           update_interval=self.output_flush_interval,
+                                           prefix='bash_kernel_jobs_')
+        self._background_jobs = jobs
+        if self._background is None or not self.background_output:
+            return
+        child = self.bashwrapper.child
+        if child.buffer:
+            self._background.write(child.buffer.replace('\r\n', '\n'))
+            child.buffer = child.string_type()
+        self._background_loop = asyncio.get_running_loop()
+        self._background_loop.add_reader(child.child_fd, self._background_output_ready)
+
+    def _background_output_ready(self):
+        try:
+            output = self.bashwrapper.child.read_nonblocking(self.bashwrapper.read_chunk_size,
+                                                             timeout=0)
+        except TIMEOUT:
+            return
+        except EOF:
+            # Bash exited: the next cell starts a new one.
+            self._stop_background_output()
+            return
+        self._background.write(output.replace('\r\n', '\n'))
+        if self._background.dirty and self._background_flush is None:
+            self._background_flush = self._background_loop.call_later(
+                self.output_flush_interval, self._flush_background_output)
+
+    def _flush_background_output(self):
+        self._background_flush = None
+        self._background.flush()
+
+    def _stop_background_output(self):
+        """Stops reading the output of background jobs, e.g. before a cell runs."""
+        if self._background_loop is None:
+            return
+        self._background_loop.remove_reader(self.bashwrapper.child.child_fd)
+        self._background_loop = None
+        if self._background_flush is not None:
+            self._background_flush.cancel()
+            self._background_flush = None
+        self._background.flush()
+
+    def _start_sidecar(self):
+        """Starts the sidecar bash. Runs in a thread of its own, as it takes a while."""
+        child = None
+        try:
+            child = self._spawn_bash()
+            with self._sidecar_lock:
+                if self._shut_down:
+                    child.close(force=True)
+                    return
+                self._sidecar_child = child
+            child.delaybeforesend = None
+            sidecar = self._wrap_bash(child)
+            init_file = os.path.join(self._tmpdir, 'sidecar.sh')
+            with open(init_file, 'w', encoding='utf-8') as f:
+                f.write('\n'.join([build_completion_cmds(), build_inspect_cmds()]))
+            sidecar.run_command('source %s' % shlex.quote(init_file))
+        except Exception:
+            if child is not None:
+                child.close(force=True)
+            # Closing it is what made it fail if the kernel shut down meanwhile.
+            if not self._shut_down:
+                self.log.warning("Could not start the sidecar bash", exc_info=True)
+            return
+        with self._sidecar_lock:
+            if not self._shut_down:
+                self._sidecar = sidecar
+
+    def _introspection_bash(self):
+        """Returns the wrapper of the bash to run introspection commands (completion, ...) in:
+        the sidecar bash while a cell is running, and the main one otherwise. Returns None
+        while a cell is running and the sidecar bash is not ready (yet)."""
+        if not self._busy:
+            return self.bashwrapper
+        if self._sidecar is None:
+            return None
+        # Follow the directory and $PATH of the main bash, as of its last prompt.
+        state = self._shell_state
+        if state is not None and (state['cwd'], state['path']) != self._sidecar_location:
+            self._sidecar.run_command('cd -- %s; PATH=%s' % (shlex.quote(state['cwd']),
+                                                            shlex.quote(state['path'])))
+            self._sidecar_location = (state['cwd'], state['path'])
+        return self._sidecar
 
-            # Send rich contents, if any:
-            for content in rich_contents:
-                if isinstance(content, Exception):
-                    message = {'name': 'stderr', 'text': str(e)}
+    def _update_state(self):
+        """Reads the session state bash wrote at the last prompt."""
+        self._shell_state = read_state(self._state_file)
+        if self._shell_state is None and self.bashwrapper.child.isalive():
+            # The cell replaced PROMPT_COMMAND: put the hook back, keeping the exit code.
+            exit_code = self.bashwrapper.exit_code
+            self.bashwrapper.run_command('__bash_kernel_install_prompt')
+            self.bashwrapper.exit_code = exit_code
+            self._shell_state = read_state(self._state_file)
+        self._command_index.update(self._shell_state)
+        self._inspection_cache.update(self._shell_state)
+
+    def do_shutdown(self, restart):
+        self._stop_background_output()
+        with self._sidecar_lock:
+            self._shut_down = True
+        for child in (self._standby, self._sidecar_child):
+            if child is not None:
+                child.close(force=True)
+        if self._parallel is not None:
+            self._parallel.close()
+        self._history.close()
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+        return {'status': 'ok', 'restart': restart}
+
+    def _output_received(self, output):
+        self._metrics.add_output(output)
+        self._output.write(output)
+
+    def send_response(self, stream, msg_or_type, *args, **kwargs):
+        self._metrics.add_message(msg_or_type)
+        return super().send_response(stream, msg_or_type, *args, **kwargs)
+
+    def process_output(self, output):
+        start = time.perf_counter()
+        self._process_output(output)
+        self._metrics.forward_time += time.perf_counter() - start
+
+    def _process_output(self, output):
+        if not self.silent:
+            # Very long lines are passed on in pieces: output not ending in a line ending
+            # is sent as is at the end, rather than being terminated by a '\n'.
+            end = max(output.rfind('\n'), output.rfind('\r')) + 1
+            # Plain output and rich contents are sent in the order they were printed.
+            for content in iter_contents(output[:end]):
+                if isinstance(content, str):
+                    # Send standard output
+                    stream_content = {'name': 'stdout', 'text': content}
+                    self.send_response(self.iopub_socket, 'stream', stream_content)
+                elif isinstance(content, Exception):
+                    message = {'name': 'stderr', 'text': str(content) + '\n'}
                     self.send_response(self.iopub_socket, 'stream', message)
                 else:
                     if 'transient' in content and 'display_id' in content['transient']:
                         self._send_content_to_display_id(content)
                     else:
                         self.send_response(self.iopub_socket, 'display_data', content)
+            if end < len(output):
+                stream_content = {'name': 'stdout', 'text': output[end:]}
+                self.send_response(self.iopub_socket, 'stream', stream_content)
+
+    def _send_spill_summary(self, spill_filename):
+        """Tells the user where the output past the output_limit went, if any."""
+        if spill_filename is None or self.silent:
+            return
+        text = ('\nbash_kernel: output limit of {} characters reached, {} more characters '
+                '({} lines) were saved to: {}\n').format(
+                    self._output_budget.limit, self._output_budget.spilled_characters,
+                    self._output_budget.spilled_lines, spill_filename)
+        self.send_response(self.iopub_socket, 'stream', {'name': 'stderr', 'text': text})
 
     def _send_content_to_display_id(self, content):
         """If display_id is not known, use "display_data", otherwise "update_display_data"."""
-        # Notice this is imperfect, because when re-running the same cell, the output cell
-        # is destroyed and the div element (the html tag) with the display_id no longer exists. But the
-        # `update_display_data` function has no way of knowing this, and thinks that the
-        # display_id still exists and will try, and fail to update it (as opposed to re-create
-        # the div with the display_id).
+        # Display ids are only known within the execution that first displayed them: when
+        # re-running the same cell, the output cell is destroyed and the div element (the
+        # html tag) with the display_id no longer exists, so `update_display_data` would
+        # fail to update it (as opposed to re-create the div with the display_id).
         #
-        # The solution is to have the user always to generate a new display_id for a cell: this
-        # way `update_display_data` will not have seen the display_id when the cell is re-run and
-        # correctly creates the new div element.
+        # Updates with the same contents as currently displayed (common in monitoring loops)
+        # are not sent at all.
         display_id = content['transient']['display_id']
+        digest = _content_digest(content)
         if display_id in self._known_display_ids:
+            self._known_display_ids.move_to_end(display_id)
+            if self._known_display_ids[display_id] == digest:
+                return
             msg_type = 'update_display_data'
         else:
             msg_type = 'display_data'
-            self._known_display_ids.add(display_id)
+            if len(self._known_display_ids) >= self.max_display_ids:
+                # Forget about the least recently updated display id.
+                self._known_display_ids.popitem(last=False)
+        self._known_display_ids[display_id] = digest
         self.send_response(self.iopub_socket, msg_type, content)
 
-    def do_execute(self, code, silent, store_history=True,
-                   user_expressions=None, allow_stdin=False):
+    async def do_execute(self, code, silent, store_history=True,
+                         user_expressions=None, allow_stdin=False):
+        self._metrics = ExecutionMetrics()
+        # The cell runs in another thread, so that the event loop stays free to answer
+        # other requests (see shell_main). SIGINT, which only the main thread gets, is
+        # passed on to the reading thread.
+        in_main_thread = threading.current_thread() is threading.main_thread()
+        if in_main_thread:
+            old_sigint_handler = signal.signal(signal.SIGINT, self._interrupt_received)
+        self._stop_background_output()
+        cwd = self._shell_state['cwd'] if self._shell_state else ''
+        self._busy = True
+        try:
+            reply = await asyncio.to_thread(self._execute, code, silent)
+        finally:
+            self._busy = False
+            if in_main_thread:
+                signal.signal(signal.SIGINT, old_sigint_handler)
+        self._watch_background_jobs(silent)
+        self._metrics.finish()
+        if store_history and not silent:
+            self._history.add(self.execution_count, code, self._exit_code,
+                              self._metrics.wall_time, cwd)
+        if self.time_to_first_execute is None:
+            # What users wait for after starting the kernel.
+            self.time_to_first_execute = time.perf_counter() - self._created
+            if self.log is not None:
+                self.log.info("First execution finished %.3f s after the kernel was created",
+                              self.time_to_first_execute)
+        if self.metrics_log:
+            try:
+                log_metrics(self.metrics_log, self._metrics,
+                            execution_count=self.execution_count, status=reply['status'],
+                            code=code.strip().split('\n', 1)[0][:200])
+            except OSError as e:
+                self.log.warning("Could not write execution metrics to %s: %s", self.metrics_log, e)
+        return reply
+
+    def _interrupt_received(self, signum, frame):
+        self.bashwrapper.interrupt_requested = True
+
+    async def shell_main(self, subshell_id, msg):
+        # ipykernel >= 7 handles the requests of a (sub)shell one at a time. While a cell
+        # runs, answer the requests that don't need the main bash right away, the way
+        # ipykernel does for comm messages.
+        if (_CONCURRENT_DISPATCH and self._busy and subshell_id is None
+                and self.session is not None and hasattr(self, '_shell_parent_ident')):
+            try:
+                _, frames = self.session.feed_identities(msg, copy=False)
+                header = self.session.deserialize(frames, content=False, copy=False)['header']
+            except Exception:
+                header = {}
+            if header.get('msg_type') in _CONCURRENT_REQUESTS:
+                shell_parent = self.get_parent('shell')
+                shell_ident = self._get_shell_context_var(self._shell_parent_ident)
+                try:
+                    await self.dispatch_shell(msg, subshell_id=subshell_id, concurrent=True)
+                finally:
+                    self.set_parent(shell_ident, shell_parent, channel='shell')
+                return
+        await super().shell_main(subshell_id, msg)
+
+    def finish_metadata(self, parent, metadata, reply_content):
+        metadata = super().finish_metadata(parent, metadata, reply_content)
+        metadata['metrics'] = self._metrics.to_dict()
+        return metadata
+
+    def _execute(self, code, silent):
         self.silent = silent
+        self._exit_code = None
+        parallel, code = strip_parallel_magic(code)
+        try:
+            limits, code = strip_limits_magic(code)
+            time_limit, cpu_limit, memory_limit = self._cell_limits(limits or {})
+        except ValueError as e:
+            return self._error_reply('', str(e))
+        profile, code = strip_profile_magic(code)
+        if parallel and (limits is not None or profile):
+            return self._error_reply('', "%%limits and %%profile don't apply to %%parallel "
+                                         "cells, which run in a worker bash")
+        profile = profile or self.profile_cells
         if not code.strip():
             return {'status': 'ok', 'execution_count': self.execution_count,
                     'payload': [], 'user_expressions': {}}
 
         
         if code.strip().endswith("\\"):
-            error_content = {
-                'ename': '',
-                'evalue': "Cell has trailing backslash",
-                'traceback': []
-            }
-            self.send_response(self.iopub_socket, 'error', error_content)
-            error_content['execution_count'] = self.execution_count
-            error_content['status'] = 'error'
-            return error_content
+            return self._error_reply('', "Cell has trailing backslash")
+
+        if parallel:
+            return self._run_parallel(code, silent)
 
         interrupted = False
+        timed_out = False
+        cpu_exceeded = False
+        bash_killed = None
+        cpu_deadline_passed = False
+        self.bashwrapper.interrupt_requested = False
+        if time_limit:
+            self.bashwrapper.deadline = time.monotonic() + time_limit
+        bash_pid = self.bashwrapper.child.pid
+        cpu_deadline = cpu_time(bash_pid) + cpu_limit if cpu_limit else None
+        self.bashwrapper.cpu_deadline = cpu_deadline
+        try:
+            previous_limits = apply_limits(bash_pid, cpu_limit, memory_limit)
+        except OSError as e:
+            previous_limits = []
+            if self.log is not None:
+                self.log.warning("Could not set the resource limits of bash: %s", e)
+        self._output_budget.start()
+        self._known_display_ids.clear()
         try:
             # Note: timeout=None tells IREPLWrapper to do incremental
             # output.  Also note that the return value from
             # run_command is not needed, because the output was
             # already sent by IREPLWrapper.
-            self.bashwrapper.run_command(code.rstrip(), timeout=None)
+            code = code.rstrip()
+            if profile:
+                code = wrap_code(code, self._profile_file)
+            if cpu_limit:
+                code = wrap_limits_code(code)
+            self.bashwrapper.run_command(code, timeout=None)
         except KeyboardInterrupt:
             self.bashwrapper.child.sendintr()
             interrupted = True
+            self._output.flush()
             self.bashwrapper._expect_prompt()
-            output = self.bashwrapper.child.before
-            self.process_output(output)
+            self._stopped_output(self.bashwrapper.child.before)
+            # The interrupt may have come before the end of the wrappers.
+            self._stop_wrappers(cpu_limit, profile)
+        except TimeLimitExceeded as e:
+            timed_out = True
+            cpu_exceeded = isinstance(e, CPUTimeLimitExceeded)
+            self._output.flush()
+            if self._stop_cell():
+                self._stopped_output(self.bashwrapper.child.before)
+                self._stop_wrappers(cpu_limit, profile)
+            else:
+                self._restart_after_exit()
         except EOF:
-            output = self.bashwrapper.child.before + 'Restarting Bash'
-            self._start_bash()
-            self.process_output(output)
+            self._output.flush()
+            child = self.bashwrapper.child
+            # Read before bash is reaped: it may have been killed by the hard limit.
+            cpu_deadline_passed = (cpu_deadline is not None
+                                   and cpu_time(bash_pid) >= cpu_deadline)
+            child.isalive()
+            bash_killed = child.signalstatus
+            self._restart_after_exit()
+        else:
+            self._output.flush()
+        finally:
+            self.bashwrapper.deadline = None
+            self.bashwrapper.cpu_deadline = None
+            restore_limits(bash_pid, previous_limits)
+        self._send_spill_summary(self._output_budget.finish())
+        self._update_state()
+        # Read on every path, so that the marker file doesn't outlive the cell.
+        killed_by_cpu_limit = bool(cpu_limit) and command_killed(self._cpu_marker_file)
+        if profile and not silent:
+            self._send_profile()
 
         if interrupted:
             return {'status': 'abort', 'execution_count': self.execution_count}
 
-        try:
-            exitcode = int(self.bashwrapper.run_command('{ echo $?; } 2>/dev/null').rstrip().split("\r\n")[0])
-        except Exception as exc:
-            exitcode = 1
-
-        if exitcode:
-            error_content = {
-                'ename': '',
-                'evalue': str(exitcode),
-                'traceback': []
-            }
-            self.send_response(self.iopub_socket, 'error', error_content)
-
-            error_content['execution_count'] = self.execution_count
-            error_content['status'] = 'error'
-            return error_content
+        if cpu_exceeded or (cpu_limit and (bash_killed == signal.SIGXCPU or (
+                bash_killed == signal.SIGKILL and cpu_deadline_passed))):
+            # Bash itself used more CPU time than allowed, or was killed by the (hard)
+            # limit anyway, past the CPU time it was allowed.
+            return self._error_reply('CPUTimeLimitExceeded',
+                                     'Bash used more than the CPU time limit of the cell '
+                                     'of %g s' % cpu_limit)
+
+        if timed_out:
+            return self._error_reply('TimeLimitExceeded',
+                                     'The cell ran for longer than its time limit of %g s'
+                                     % time_limit)
+
+        exitcode = self.bashwrapper.exit_code
+        self._exit_code = exitcode
+
+        if cpu_limit and (exitcode == CPU_LIMIT_EXIT_CODE or killed_by_cpu_limit):
+            return self._error_reply('CPUTimeLimitExceeded',
+                                     'A command of the cell used more than its CPU time '
+                                     'limit of %g s' % cpu_limit)
+        elif exitcode:
+            return self._error_reply('', str(exitcode))
         else:
+            key = checkpoint_key(self._shell_state)
+            if key is not None and key != self._checkpoint_key:
+                try:
+                    write_snapshot(self._shell_state, self._snapshot_file)
+                    self._checkpoint_key = key
+                except OSError as e:
+                    self.log.warning("Could not save the session state to %s: %s",
+                                     self._snapshot_file, e)
             return {'status': 'ok', 'execution_count': self.execution_count,
                     'payload': [], 'user_expressions': {}}
 
+    def _stop_wrappers(self, cpu_limit, profile):
+        """Runs the end of the wrappers of a cell that was interrupted."""
+        if profile:
+            self.bashwrapper.run_command('__bash_kernel_profile_stop')
+        if cpu_limit:
+            self.bashwrapper.run_command(LIMITS_STOP_CMD)
+
+    def _send_profile(self):
+        profile = read_profile(self._profile_file)
+        if profile:
+            self.send_response(self.iopub_socket, 'display_data', profile_display_data(profile))
+
     def do_complete(self, code, cursor_pos):
         code = code[:cursor_pos]
         default = {'matches': [], 'cursor_start': 0,
@@ -259,40 +991,53 @@ class BashKernel(Kernel):
         tokens = re.split("[\t \n;=\"'><]+", code)
         token = tokens[-1]
         start = cursor_pos - len(token)
+        # All the candidates are found by a single call to bash, see completion.py,
+        # except command names, which are kept in an index (see state.py).
+        kinds = []
         if token and token[0] == '$':
             # complete variables
-            cmd = 'compgen -A arrayvar -A export -A variable %s' % token[1:] # strip leading $
-            output = self.bashwrapper.run_command(cmd).rstrip()
-            completions = set(output.split())
-            # append matches including leading $
-            matches.extend(['$'+c for c in completions])
-        else:
-            # complete path 
-            cmd = 'compgen -d -S / %s' % token
-            output = self.bashwrapper.run_command(cmd).rstrip()
-            dirs = list(set(output.split()))
-            cmd = 'compgen -f %s' % token
-            output = self.bashwrapper.run_command(cmd).rstrip()
-            filesanddirs = list(set(output.split()))
-            files = [x for x in filesanddirs if x + "/" not in dirs]
+            kinds.append('v')
+        elif '/' in token or token in ('', '.'):
+            # complete path (relative paths get an explicit "./" below, so they
+            # can only match a token that is a prefix of "./")
+            kinds.extend(['d', 'f'])
+        if '/' not in token and code[-1] != '"':
+            # complete anything command-like (avoid annoying errors where command names get completed after a directory)
+            kinds.append('c')
+        if code[-1] == '"':
+            # complete variables
+            kinds.append('v')
+        # The command being completed, if the cursor is past its name: use its
+        # programmable completion (e.g. for git), if it has one.
+        command_line = re.split("[;|&(]", code.split('\n')[-1])[-1].lstrip()
+        if not token.startswith('$') and re.search(r'\s', command_line):
+            kinds.append('p')
+        completions = {}
+        bash_kinds = [kind for kind in kinds if kind != 'c']
+        bash = self._introspection_bash() if bash_kinds else None
+        if bash is not None:
+            cmd = '__bash_kernel_complete %d %s %s %s' % (
+                self.max_completions, shlex.quote(' '.join(bash_kinds)),
+                shlex.quote(token), shlex.quote(command_line))
+            completions = parse_completions(bash.run_command(cmd))
+        if 'c' in kinds:
+            completions['c'] = self._command_index.complete(token, self.max_completions)
+
+        if completions.get('p'):
+            matches.extend(set(completions['p']))
+        elif 'd' in kinds:
+            dirs = list(set(completions.get('d', [])))
+            files = [x for x in set(completions.get('f', [])) if x + "/" not in dirs]
             if '/' not in token:
                 # Add an explict ./ for relative paths
                 matches.extend(["./" + x for x in files + dirs])
             else:
                 matches.extend(files)
                 matches.extend(dirs)
-        if '/' not in token and code[-1] != '"':
-            # complete anything command-like (avoid annoying errors where command names get completed after a directory)
-            cmd = 'compgen -abc -A function %s' % token
-            output = self.bashwrapper.run_command(cmd).rstrip()
-            matches.extend(list(set(output.split())))
-        if code[-1] == '"':
-            # complete variables
-            cmd = 'compgen -A arrayvar -A export -A variable %s' % token[1:] # strip leading $
-            output = self.bashwrapper.run_command(cmd).rstrip()
-            completions = set(output.split())
-            # append matches including leading $
-            matches.extend(['$'+c for c in completions])
+        if 'c' in kinds and not completions.get('p'):
+            matches.extend(set(completions.get('c', [])))
+        # append variable matches including leading $
+        matches.extend(['$' + c for c in set(completions.get('v', []))])
 
         if not matches:
             return default
@@ -301,3 +1046,44 @@ class BashKernel(Kernel):
         return {'matches': sorted(matches), 'cursor_start': start,
                 'cursor_end': cursor_pos, 'metadata': dict(),
                 'status': 'ok'}
+
+    async def do_history(self, hist_access_type, output, raw, session=None, start=None,
+                         stop=None, n=None, pattern=None, unique=False, **kwargs):
+        if hist_access_type == 'range':
+            history = await asyncio.to_thread(self._history.get_range, session, start, stop)
+        elif hist_access_type == 'tail':
+            history = await asyncio.to_thread(self._history.get_tail, n)
+        elif hist_access_type == 'search':
+            history = await asyncio.to_thread(self._history.search, pattern or '*', n, unique)
+        else:
+            history = []
+        if output:
+            # Outputs are not saved.
+            history = [(session, line, (code, None)) for session, line, code in history]
+        return {'status': 'ok', 'history': history}
+
+    def do_is_complete(self, code):
+        status, indent = is_complete(code)
+        reply = {'status': status}
+        if status == 'incomplete':
+            reply['indent'] = indent
+        return reply
+
+    def do_inspect(self, code, cursor_pos, detail_level=0, omit_sections=()):
+        reply = {'status': 'ok', 'found': False, 'data': {}, 'metadata': {}}
+        name = word_at(code, cursor_pos)
+        if not name:
+            return reply
+        result = self._inspection_cache.get(name)
+        if result is None:
+            bash = self._introspection_bash()
+            if bash is None:
+                return reply
+            result = bash.run_command(
+                '__bash_kernel_inspect %s 2>/dev/null' % shlex.quote(name))
+            result = result.replace('\r\n', '\n').strip()
+            self._inspection_cache.set(name, result)
+        if result:
+            reply['found'] = True
+            reply['data'] = {'text/plain': result}
+        return reply
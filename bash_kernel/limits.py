@@ -0,0 +1,206 @@
+"""limits.py limits the wall-clock time, CPU time and memory a cell may use.
+
+The limits of every cell are set by the `BashKernel.cell_time_limit`, `cell_cpu_limit` and
+`cell_memory_limit` options of the session, and a cell can set its own with a first line
+like:
+
+$ %%limits time=10m cpu=60 memory=2G
+
+CPU time and memory are limited with the resource limits (`ulimit -t` and `ulimit -v`) of
+bash, which the processes it starts inherit. The kernel sets them with `prlimit()` on the
+bash process right before the cell runs, and restores them afterwards (see
+`apply_limits()`), which costs no round-trip to bash. Only the soft limits are changed, so
+a cell can raise them again with `ulimit -S`: they are meant to catch runaway cells, not
+to isolate users from each other. Both limits apply to each process on its own, not to
+the cell as a whole:
+
+- a process that uses more CPU time than allowed (rounded up to whole seconds) gets
+  SIGXCPU, and is killed. Bash only reports that in the exit status of the command, which
+  the next command of the cell replaces, so cells with a CPU time limit are wrapped
+  between `__bash_kernel_limits_start` and `STOP_CMD` (see `wrap_code()`): the first sets
+  an ERR trap that creates a marker file when a command exits with `CPU_LIMIT_EXIT_CODE`,
+  followed by the ERR trap of the session, the second puts that one back. The trap doesn't run for commands
+  whose status is tested (`if`, `||`, ...), nor within functions and subshells, whose
+  own status counts instead.
+- allocating memory past the limit fails, which most programs report as an error.
+
+Bash itself must survive its CPU time limit, as its CPU time accumulates over the session:
+it ignores SIGXCPU with a trap (see `build_cmds()`), which the processes it starts don't
+inherit. Instead, the CPU time bash uses during the cell (e.g. in a `while` loop of the
+cell) is checked by the kernel, like the wall-clock time.
+
+The wall-clock time is checked by the kernel while it reads the output of the cell:
+`IREPLWrapper` raises `TimeLimitExceeded` past its deadline, or `CPUTimeLimitExceeded` once
+bash used more CPU time than the cell may. The kernel then interrupts the cell like the
+interrupt button does, and kills what is left of it if that doesn't work.
+
+Resource limits need Linux (`resource.prlimit`). Elsewhere, only the wall-clock time is
+limited.
+"""
+import math
+import os
+import shlex
+import signal
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# First line of the cells that set their own limits.
+LIMITS_MAGIC = '%%limits'
+
+# Exit code of a process killed by SIGXCPU, as bash reports it.
+CPU_LIMIT_EXIT_CODE = 128 + getattr(signal, 'SIGXCPU', 24)
+
+_TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+_SIZE_UNITS = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+
+class TimeLimitExceeded(Exception):
+    """Raised when a cell runs for longer than its wall-clock time limit."""
+
+
+class CPUTimeLimitExceeded(TimeLimitExceeded):
+    """Raised when bash itself uses more CPU time than the limit of the cell."""
+
+
+_LIMITS_CMD = """
+trap : XCPU
+
+__bash_kernel_limits_trap () {
+    [[ $1 != %(exit_code)d ]] || : >%(marker_file)s
+    # In a profiled cell, mark the extra run of the command the DEBUG trap recorded.
+    [[ -z ${__bash_kernel_profile_fd-} ]] ||
+        printf '%%s %%s\\n' "$EPOCHREALTIME" __bash_kernel_limits_trap >&$__bash_kernel_profile_fd
+    return $1
+}
+
+__bash_kernel_limits_start () {
+    __bash_kernel_err_trap=$1
+    local -a __bk_trap=()
+    [[ -z $1 ]] || eval "__bk_trap=($1)"
+    # The ERR trap of the session still runs, after ours.
+    trap "__bash_kernel_limits_trap \\$?${__bk_trap[2]:+; ${__bk_trap[2]}}" ERR
+}
+
+__bash_kernel_limits_stop () {
+    local __bk_status=$__bash_kernel_limits_status
+    unset __bash_kernel_err_trap __bash_kernel_limits_status
+    return $__bk_status
+}
+"""
+
+
+def build_cmds(marker_file):
+    """Returns the bash commands keeping bash alive past its CPU time limit, and those
+    recording the commands killed by theirs to marker_file (see `wrap_code()`).
+
+    A trap replaces the default action of SIGXCPU (being killed) in bash only, as trapped
+    signals are reset in subshells and the commands bash runs."""
+    return _LIMITS_CMD % {'exit_code': CPU_LIMIT_EXIT_CODE,
+                          'marker_file': shlex.quote(marker_file)}
+
+
+# Ends a wrapped cell. Functions don't see the ERR trap of the session, and bash puts it
+# back when they return, so it is read and restored outside of them.
+STOP_CMD = ('__bash_kernel_limits_status=$?; trap - ERR; eval "$__bash_kernel_err_trap"; '
+            '__bash_kernel_limits_stop')
+
+
+def wrap_code(code):
+    """Returns code with the commands killed by their CPU time limit recorded to the
+    marker file given to `build_cmds()`."""
+    return '__bash_kernel_limits_start "$(trap -p ERR)"; %s\n%s' % (code, STOP_CMD)
+
+
+def command_killed(marker_file):
+    """Returns whether a command of the last wrapped cell was killed by its CPU time
+    limit, and removes marker_file."""
+    try:
+        os.remove(marker_file)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def parse_time(value):
+    """Parses a duration in seconds, with an optional s, m or h suffix."""
+    unit = _TIME_UNITS.get(value[-1:].lower())
+    try:
+        return float(value[:-1] if unit else value) * (unit or 1)
+    except ValueError:
+        raise ValueError('Invalid time limit "%s", use e.g. 30, 90s, 10m or 2h' % value)
+
+
+def parse_size(value):
+    """Parses a number of bytes, with an optional K, M, G or T suffix."""
+    text = value.lower().rstrip('b')
+    unit = _SIZE_UNITS.get(text[-1:])
+    number = text[:-1] if unit else text
+    try:
+        return int(float(number) * (unit or 1))
+    except ValueError:
+        raise ValueError('Invalid memory limit "%s", use e.g. 512M or 2G' % value)
+
+
+def strip_limits_magic(code):
+    """Returns the limits set by the `%%limits` line code starts with (a dict with the time,
+    cpu and memory keys that are given, None if there is no such line), and code without
+    that line. Raises ValueError for invalid limits."""
+    first_line, _, rest = code.lstrip('\n').partition('\n')
+    words = first_line.split()
+    if not words or words[0] != LIMITS_MAGIC:
+        return None, code
+    limits = {}
+    for word in words[1:]:
+        name, _, value = word.partition('=')
+        if name == 'time':
+            limits['time'] = parse_time(value)
+        elif name == 'cpu':
+            limits['cpu'] = parse_time(value)
+        elif name == 'memory':
+            limits['memory'] = parse_size(value)
+        else:
+            raise ValueError('Unknown limit "%s", use time=, cpu= or memory=' % name)
+    return limits, rest
+
+
+def cpu_time(pid):
+    """Returns the CPU time (in seconds) used by process pid so far, or 0 if unknown."""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            # The fields following the command name, which may contain spaces.
+            fields = f.read().rpartition(')')[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def apply_limits(pid, cpu=0, memory=0):
+    """Sets the soft CPU time (in seconds) and address space (in bytes) limits of process
+    pid, 0 meaning no limit. Returns what to pass to `restore_limits()` afterwards."""
+    if resource is None or not hasattr(resource, 'prlimit') or not (cpu or memory):
+        return []
+    previous = []
+    for kind, limit in ((resource.RLIMIT_CPU, cpu), (resource.RLIMIT_AS, memory)):
+        if not limit:
+            continue
+        if kind == resource.RLIMIT_CPU:
+            limit = math.ceil(limit)
+        soft, hard = resource.prlimit(pid, kind)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.prlimit(pid, kind, (limit, hard))
+        previous.append((kind, (soft, hard)))
+    return previous
+
+
+def restore_limits(pid, previous):
+    for kind, limits in previous:
+        try:
+            resource.prlimit(pid, kind, limits)
+        except (OSError, ValueError):
+            # Bash exited.
+            pass
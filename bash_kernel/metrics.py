@@ -0,0 +1,55 @@
+"""metrics.py measures each execution, so that slow cells and cells flooding the frontend can
+be found.
+
+`ExecutionMetrics` is started at the beginning of `do_execute`, and told about the output
+of the cell and the messages sent for it. Its numbers end up in the metadata of the
+execute_reply (under "metrics") and, if `BashKernel.metrics_log` is set, are appended as
+one JSON line per execution to that file.
+"""
+import json
+import time
+
+
+class ExecutionMetrics:
+    def __init__(self):
+        self._start = time.perf_counter()
+        self.started = time.time()
+        self.wall_time = 0.0
+        # Time spent processing and sending output, rather than waiting for bash.
+        self.forward_time = 0.0
+        self.output_bytes = 0
+        self.output_lines = 0
+        self.iopub_messages = 0
+        self.rich_displays = 0
+
+    def add_output(self, text):
+        self.output_bytes += len(text) if text.isascii() else len(text.encode('utf-8', 'replace'))
+        self.output_lines += text.count('\n')
+
+    def add_message(self, msg_type):
+        self.iopub_messages += 1
+        if msg_type in ('display_data', 'update_display_data'):
+            self.rich_displays += 1
+
+    def finish(self):
+        self.wall_time = time.perf_counter() - self._start
+
+    def to_dict(self):
+        return {
+            'wall_time': self.wall_time,
+            'bash_time': max(0.0, self.wall_time - self.forward_time),
+            'forward_time': self.forward_time,
+            'output_bytes': self.output_bytes,
+            'output_lines': self.output_lines,
+            'iopub_messages': self.iopub_messages,
+            'rich_displays': self.rich_displays,
+        }
+
+
+def log_metrics(filename, metrics, **fields):
+    """Appends the metrics of an execution, and any extra fields, as a JSON line to filename."""
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(metrics.started))}
+    record.update(fields)
+    record.update(metrics.to_dict())
+    with open(filename, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
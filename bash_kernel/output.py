@@ -0,0 +1,206 @@
+"""output.py batches the incremental output of a running cell before it is sent to the frontend.
+
+`IREPLWrapper` reports output as soon as it sees a line ending, and sending one `stream`
+message per line is far too slow for commands that print many lines (`cat` of a big log
+file, a verbose build, ...): every message is serialized and sent over ZMQ, and has to be
+rendered by the frontend. Instead, `OutputCoalescer` collects the output and passes it on
+in batches, whenever `flush_interval` seconds have passed since the last batch or
+`flush_size` characters have accumulated, whichever comes first.
+
+Within a batch, runs of progress-bar updates (lines terminated by a bare carriage return)
+are collapsed to their last frame, since each frame overwrites the previous one anyway.
+
+Rich content markers (see display.py) are kept in the batch text, in their original
+position, so they are displayed in the right order relative to the text around them.
+
+`OutputBudget` limits how much output of a single cell is sent to the frontend: past the
+limit, output is written to a spill file instead, and only a summary is shown at the end.
+
+`TextDisplay` shows output that arrives outside of a running cell (from %%parallel cells
+and background jobs) in a single display of the cell it belongs to, updated in place.
+"""
+import re
+import tempfile
+import time
+import uuid
+
+
+# A run of lines terminated by a bare '\r' (not part of '\r\n'), followed by one more such line.
+# Only the last one of those will be visible, so the earlier ones are dropped.
+_OVERWRITTEN_FRAMES_RE = re.compile(r'(?:[^\r\n]*\r(?!\n))+(?=[^\r\n]*\r(?!\n))')
+
+
+# Number of characters at the end of the text of a TextDisplay that are shown.
+DISPLAY_TAIL = 65536
+
+
+def collapse_carriage_returns(text):
+    """Drop progress-bar frames that are overwritten by a later frame in the same text."""
+    return _OVERWRITTEN_FRAMES_RE.sub('', text)
+
+
+def _visible_text(text):
+    """Returns text as a terminal would show it: only the last frame of lines rewritten
+    with carriage returns."""
+    return '\n'.join(line.rstrip('\r').rpartition('\r')[2] for line in text.split('\n'))
+
+
+class OutputCoalescer:
+    """Collects output and passes it on to `send` in time/size-bounded batches.
+
+    :param send: a callback receiving each batch of output as one string.
+    :param flush_interval: maximum time (in seconds) output is held before being sent.
+    :param flush_size: number of characters after which a batch is sent immediately.
+    """
+    def __init__(self, send, flush_interval=0.05, flush_size=65536):
+        self.send = send
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pieces = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, text):
+        self._pieces.append(text)
+        self._size += len(text)
+        if (self._size >= self.flush_size or
+                time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._pieces:
+            return
+        text = ''.join(self._pieces)
+        self._pieces = []
+        self._size = 0
+        if '\r' in text:
+            text = collapse_carriage_returns(text)
+        self.send(text)
+
+
+class OutputBudget:
+    """Passes on at most `limit` characters of output per cell to `send`, and writes the
+    rest to a spill file.
+
+    :param send: a callback receiving the output within the budget.
+    :param limit: number of characters sent per cell, or 0 for no limit.
+    :param keep_prefix: lines starting with this prefix are always sent, even past the
+      limit (used for rich content markers, which are short).
+    """
+    def __init__(self, send, limit=0, keep_prefix=None):
+        self.send = send
+        self.limit = limit
+        self.keep_prefix = keep_prefix
+        self.start()
+
+    def start(self):
+        """Starts the budget of a new cell."""
+        self._remaining = self.limit
+        self._spill = None
+        self.spilled_characters = 0
+        self.spilled_lines = 0
+
+    def write(self, text):
+        if not self.limit:
+            self.send(text)
+            return
+        if self._remaining > 0:
+            sent = text[:self._remaining]
+            if len(sent) < len(text):
+                # Cut at the last line break, so that rich content markers are not split.
+                # Lines longer than what is left are cut, but for such markers.
+                end = sent.rfind('\n') + 1
+                if end:
+                    sent = sent[:end]
+                elif self.keep_prefix is not None and text.startswith(self.keep_prefix):
+                    sent = ''
+                self._remaining = 0
+            else:
+                self._remaining -= len(sent)
+            if sent:
+                self.send(sent)
+            text = text[len(sent):]
+            if not text:
+                return
+        if self.keep_prefix is not None and self.keep_prefix in text:
+            kept = []
+            spilled = []
+            for line in text.splitlines(keepends=True):
+                (kept if line.startswith(self.keep_prefix) else spilled).append(line)
+            self.send(''.join(kept))
+            text = ''.join(spilled)
+        self._write_spill(text)
+
+    def _write_spill(self, text):
+        if self._spill is None:
+            self._spill = tempfile.NamedTemporaryFile(
+                prefix='bash_kernel_output.', suffix='.txt', delete=False)
+        data = text.encode('utf-8', 'replace')
+        self._spill.write(data)
+        self.spilled_characters += len(text)
+        self.spilled_lines += text.count('\n')
+
+    def finish(self):
+        """Ends the budget of the current cell, returning the spill file name, or None if
+        all the output was sent."""
+        if self._spill is None:
+            return None
+        self._spill.close()
+        return self._spill.name
+
+
+class TextDisplay:
+    """Text shown in a display, which is updated (with update_display_data) as more text
+    arrives, at most every `update_interval` seconds. Only the last `DISPLAY_TAIL`
+    characters are kept. A status line (e.g. '[done in 1.2 s]') can follow the text.
+
+    :param send: a callback sending an iopub message, taking the message type and content.
+    :param prefix: the start of the display id.
+    """
+    def __init__(self, send, update_interval=0.05, status='', prefix='bash_kernel_'):
+        self.send = send
+        self.update_interval = update_interval
+        self.display_id = prefix + uuid.uuid4().hex
+        self.status = status
+        self.shown = False
+        self._text = ''
+        self._hidden = 0
+        self._last_update = 0.0
+        # Whether there is text not shown yet.
+        self.dirty = False
+
+    def _content(self):
+        text = _visible_text(self._text)
+        if self._hidden:
+            text = '[%d earlier characters not shown]\n%s' % (self._hidden, text)
+        if self.status:
+            if text and not text.endswith('\n'):
+                text += '\n'
+            text += self.status
+        return {'data': {'text/plain': text}, 'metadata': {},
+                'transient': {'display_id': self.display_id}}
+
+    def update(self):
+        """Shows the current text and status, creating the display if needed."""
+        self._last_update = time.monotonic()
+        self.dirty = False
+        self.send('update_display_data' if self.shown else 'display_data', self._content())
+        self.shown = True
+
+    def set_status(self, status):
+        self.status = status
+        self.update()
+
+    def write(self, text):
+        self._text += text
+        self.dirty = True
+        if len(self._text) > DISPLAY_TAIL:
+            self._hidden += len(self._text) - DISPLAY_TAIL
+            self._text = self._text[-DISPLAY_TAIL:]
+        if time.monotonic() - self._last_update >= self.update_interval:
+            self.update()
+
+    def flush(self):
+        if self.dirty:
+            self.update()
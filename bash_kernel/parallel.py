@@ -0,0 +1,162 @@
+"""parallel.py runs independent cells in a pool of worker bash processes, alongside the main one.
+
+A cell whose first line is `%%parallel` is not run by the main bash. Instead, the kernel
+saves the working directory, exported variables, functions and aliases of the main bash to
+a snapshot file (see `__bash_kernel_checkpoint` in state.py) and queues the cell for
+`WorkerPool`. The execution of the cell finishes right away, so that the next cells can
+run, while one of the workers sources the snapshot and runs the cell. Changes a parallel
+cell makes to its shell (`cd`, `export`, ...) don't affect the main bash or other cells.
+
+The output of the cell goes to a display in the cell's output area (a `TextDisplay` of
+output.py), which `ParallelJob` keeps updating until the cell finished. Only text is
+shown: the rich display functions of display.py, which the snapshot defines, are replaced
+in workers by functions failing with an error message.
+
+Worker bash processes are started when first needed, and kept for later cells.
+"""
+import os
+import queue
+import shlex
+import threading
+import time
+
+from pexpect import EOF
+
+from .display import CONTENT_DATA_PREFIXES
+from .output import TextDisplay
+
+
+# First line of the cells to run in parallel.
+PARALLEL_MAGIC = '%%parallel'
+
+# Replaces the display functions sourced from the snapshot of the main bash.
+_NO_DISPLAY_CMD = '; '.join(['unset NOTEBOOK_BASH_KERNEL_CAPABILITIES'] + [
+    '%s () { echo "%s: rich content is not shown in %%%%parallel cells" >&2; return 1; }'
+    % (info['display_cmd'], info['display_cmd']) for info in CONTENT_DATA_PREFIXES.values()])
+
+
+def strip_parallel_magic(code):
+    """Returns whether code starts with the `%%parallel` line, and code without that line."""
+    first_line, _, rest = code.lstrip('\n').partition('\n')
+    if first_line.strip() == PARALLEL_MAGIC:
+        return True, rest
+    return False, code
+
+
+class ParallelJob:
+    """A cell queued for a worker, and the display showing its output.
+
+    :param send: a callback sending an iopub message, taking the message type and content.
+    :param update_interval: minimum time (in seconds) between updates of the display.
+    """
+    def __init__(self, code, snapshot_file, send, update_interval=0.05):
+        self.code = code
+        self.snapshot_file = snapshot_file
+        self.display = TextDisplay(send, update_interval, status='[queued]',
+                                   prefix='bash_kernel_parallel_')
+        self._started = None
+
+    def show(self):
+        """Creates the display of the job, in the output area of the current cell."""
+        self.display.update()
+
+    def start(self):
+        self._started = time.monotonic()
+        self.display.set_status('')
+
+    def write(self, text):
+        self.display.write(text)
+
+    def flush(self):
+        self.display.flush()
+
+    def finish(self, exit_code):
+        elapsed = time.monotonic() - self._started
+        if exit_code is None:
+            status = '[bash exited after %.1f s]' % elapsed
+        elif exit_code:
+            status = '[exit code %d after %.1f s]' % (exit_code, elapsed)
+        else:
+            status = '[done in %.1f s]' % elapsed
+        self.display.set_status(status)
+
+
+class _Worker:
+    """A thread running jobs of the pool in its own bash."""
+    def __init__(self, pool):
+        self.pool = pool
+        self.job = None
+        self.bashwrapper = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _output(self, text):
+        self.job.write(text)
+
+    def _idle(self):
+        self.job.flush()
+
+    def _run(self):
+        while True:
+            job = self.pool._jobs.get()
+            if job is None:
+                self.pool._jobs.task_done()
+                return
+            self.job = job
+            try:
+                self._run_job(job)
+            finally:
+                self.job = None
+                try:
+                    os.remove(job.snapshot_file)
+                except OSError:
+                    pass
+                self.pool._jobs.task_done()
+
+    def _run_job(self, job):
+        if self.bashwrapper is None:
+            self.bashwrapper = self.pool.start_bash(self._output, self._idle)
+        job.start()
+        try:
+            # Errors are expected, e.g. for readonly variables.
+            self.bashwrapper.run_command('source %s >/dev/null 2>&1; %s'
+                                         % (shlex.quote(job.snapshot_file), _NO_DISPLAY_CMD))
+            self.bashwrapper.run_command(job.code, timeout=None)
+        except EOF:
+            job.write(self.bashwrapper.child.before)
+            self.bashwrapper = None
+            job.finish(None)
+        else:
+            job.finish(self.bashwrapper.exit_code)
+
+
+class WorkerPool:
+    """Runs `ParallelJob`s in up to `size` worker bash processes.
+
+    :param start_bash: a callback returning the IREPLWrapper of a new bash, given the
+      line_output_callback and idle_callback for it.
+    """
+    def __init__(self, start_bash, size=4):
+        self.start_bash = start_bash
+        self.size = size
+        self._jobs = queue.Queue()
+        self._workers = []
+
+    def submit(self, job):
+        """Queues job, after showing its display."""
+        job.show()
+        self._jobs.put(job)
+        busy = sum(1 for worker in self._workers if worker.job is not None)
+        if len(self._workers) < self.size and busy + self._jobs.qsize() > len(self._workers):
+            self._workers.append(_Worker(self))
+
+    def join(self):
+        """Waits until all the queued jobs are done."""
+        self._jobs.join()
+
+    def close(self):
+        """Stops the workers, killing the jobs they are running."""
+        for worker in self._workers:
+            self._jobs.put(None)
+            if worker.bashwrapper is not None:
+                worker.bashwrapper.child.close(force=True)
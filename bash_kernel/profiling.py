@@ -0,0 +1,134 @@
+"""profiling.py times each command of a cell, to find out which ones are slow.
+
+A cell is profiled when its first line is `%%profile` (or every cell, with
+`BashKernel.profile_cells`). The kernel then wraps the cell between the bash functions
+defined by `build_cmds()`:
+
+$ __bash_kernel_profile_start <file>; <cell>
+$ __bash_kernel_profile_stop
+
+`__bash_kernel_profile_start` sets a DEBUG trap, which bash runs before each simple command
+of the cell (but not within functions). The trap, `__bash_kernel_profile_trace`, writes
+`$EPOCHREALTIME` and the command about to run to <file>, using only builtins, so the timing
+stream never mixes with the output of the cell. The trap removes itself when it sees
+`__bash_kernel_profile_stop` (a function can't remove a DEBUG trap, bash restores it when
+the function returns). Each command lasts until the next line of that file. When the cell finishes,
+`read_profile()` adds up the time of each command and `profile_display_data()` builds a
+table of the slowest ones, which is sent like any other rich content.
+
+Timing needs `$EPOCHREALTIME`, i.e. bash 5.0 or later.
+"""
+import html
+import shlex
+
+
+_PROFILE_CMD = """
+__bash_kernel_profile_trace () {
+    printf '%s %s\\n' "$EPOCHREALTIME" "${BASH_COMMAND//$'\\n'/ }" >&$__bash_kernel_profile_fd
+}
+
+__bash_kernel_profile_start () {
+    exec {__bash_kernel_profile_fd}>"$1"
+    trap '__bash_kernel_profile_trace
+          [[ $BASH_COMMAND != __bash_kernel_profile_stop ]] || trap - DEBUG' DEBUG
+}
+
+__bash_kernel_profile_stop () {
+    local __bk_status=$?
+    if [[ -n "$__bash_kernel_profile_fd" ]]; then
+        printf '%s %s\\n' "$EPOCHREALTIME" __bash_kernel_profile_stop >&$__bash_kernel_profile_fd
+        exec {__bash_kernel_profile_fd}>&-
+        unset __bash_kernel_profile_fd
+    fi
+    return $__bk_status
+}
+"""
+
+# Prefix of the commands run by the kernel between the commands of the cell (e.g. the hooks
+# of PROMPT_COMMAND): they mark the end of the previous command, but are not part of the
+# profile.
+_KERNEL_COMMAND_PREFIX = '__bash_kernel_'
+
+# The line the ERR trap of cells with a CPU time limit adds to their profile, see limits.py.
+_ERR_TRAP_COMMAND = '__bash_kernel_limits_trap'
+
+# First line of the cells to profile.
+PROFILE_MAGIC = '%%profile'
+
+# Number of commands shown in the profile table.
+TOP_COMMANDS = 20
+
+
+def build_cmds():
+    return _PROFILE_CMD
+
+
+def strip_profile_magic(code):
+    """Returns whether code starts with the `%%profile` line, and code without that line."""
+    first_line, _, rest = code.lstrip('\n').partition('\n')
+    if first_line.strip() == PROFILE_MAGIC:
+        return True, rest
+    return False, code
+
+
+def wrap_code(code, profile_file):
+    """Returns code with the profiling of its commands to profile_file turned on."""
+    return '__bash_kernel_profile_start %s; %s\n__bash_kernel_profile_stop' % (
+        shlex.quote(profile_file), code)
+
+
+def read_profile(profile_file):
+    """Returns a list of (command, total seconds, number of runs), slowest first."""
+    try:
+        with open(profile_file, encoding='utf-8', errors='replace') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    entries = []
+    for line in lines:
+        timestamp, _, command = line.partition(' ')
+        try:
+            timestamp = float(timestamp)
+        except ValueError:
+            # No $EPOCHREALTIME (bash < 5.0).
+            return []
+        if command == _ERR_TRAP_COMMAND:
+            # Bash ran the DEBUG trap for the failed command again, before the ERR trap:
+            # the command goes on until the next line.
+            if len(entries) >= 2 and entries[-1][1] == entries[-2][1]:
+                entries.pop()
+            continue
+        entries.append((timestamp, command))
+    totals = {}
+    for (timestamp, command), (next_timestamp, _) in zip(entries, entries[1:]):
+        if not command.startswith(_KERNEL_COMMAND_PREFIX):
+            total, runs = totals.get(command, (0.0, 0))
+            totals[command] = (total + next_timestamp - timestamp, runs + 1)
+    profile = [(command, total, runs) for command, (total, runs) in totals.items()]
+    profile.sort(key=lambda entry: entry[1], reverse=True)
+    return profile
+
+
+def profile_display_data(profile, top=TOP_COMMANDS):
+    """Returns the display_data content showing the top commands of profile as a table."""
+    total_time = sum(entry[1] for entry in profile) or 1.0
+    rows = profile[:top]
+    text_lines = ['%10s %6s %6s  %s' % ('seconds', '%', 'runs', 'command')]
+    html_rows = ['<tr><th>seconds</th><th>%</th><th>runs</th><th>command</th></tr>']
+    for command, seconds, runs in rows:
+        percent = 100.0 * seconds / total_time
+        text_lines.append('%10.3f %6.1f %6d  %s' % (seconds, percent, runs, command))
+        html_rows.append(
+            '<tr><td>%.3f</td><td>%.1f</td><td>%d</td><td style="text-align:left">'
+            '<code>%s</code></td></tr>' % (seconds, percent, runs, html.escape(command)))
+    if len(profile) > top:
+        text_lines.append('... %d more commands' % (len(profile) - top))
+        html_rows.append('<tr><td colspan="4">... %d more commands</td></tr>'
+                         % (len(profile) - top))
+    return {
+        'data': {
+            'text/plain': '\n'.join(text_lines),
+            'text/html': '<table>%s</table>' % ''.join(html_rows),
+        },
+        'metadata': {}
+    }
@@ -0,0 +1,200 @@
+"""runner.py runs notebooks and scripts with bash_kernel, without Jupyter (e.g. in CI):
+
+$ python -m bash_kernel run analysis.ipynb
+$ python -m bash_kernel run --stop-on-error --timings timings.json -o setup.ipynb setup.sh
+
+Running a notebook with nbclient starts a kernel process, and every message goes through
+ZMQ sockets and is serialized twice. Here `BashKernel` runs in-process instead: its session
+is an `_OutputSink`, which turns the messages it is given straight into the outputs of the
+notebook, so running the cells costs little more than the time bash takes.
+
+Scripts are split into cells at lines starting with `# %%`, as in the "percent" format of
+jupytext and VS Code, and written as notebooks.
+
+The executed notebook (by default <input>.executed.ipynb) has the outputs and execution
+count of each cell, and its status, exit code and run time in the cell metadata, under
+"bash_kernel". With `--timings`, a JSON summary of the run times is also written. The exit
+status is 0 if all cells succeeded, and 1 otherwise. Interrupting the run (Ctrl-C)
+interrupts the running cell, and no further cells are run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+import uuid
+
+from jupyter_client.session import Session
+
+from .kernel import BashKernel
+
+
+# Lines separating the cells of scripts.
+_CELL_MARKER_RE = re.compile(r'^#\s*%%.*$', re.MULTILINE)
+
+
+class _OutputSink(Session):
+    """Collects the iopub messages of the kernel as notebook outputs, per parent msg_id."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Maps the msg_id of each cell to its outputs.
+        self.outputs = {}
+        # Maps display ids to the outputs showing them.
+        self._displays = {}
+
+    def send(self, stream, msg_or_type, content=None, parent=None, ident=None, buffers=None,
+             track=False, header=None, metadata=None):
+        outputs = self.outputs.get(((parent or {}).get('header') or {}).get('msg_id'))
+        if outputs is None or not isinstance(msg_or_type, str):
+            return None
+        content = content or {}
+        if msg_or_type == 'stream':
+            if (outputs and outputs[-1]['output_type'] == 'stream'
+                    and outputs[-1]['name'] == content['name']):
+                outputs[-1]['text'] += content['text']
+            else:
+                outputs.append({'output_type': 'stream', 'name': content['name'],
+                                'text': content['text']})
+        elif msg_or_type == 'display_data':
+            output = {'output_type': 'display_data', 'data': content['data'],
+                      'metadata': content.get('metadata', {})}
+            outputs.append(output)
+            display_id = content.get('transient', {}).get('display_id')
+            if display_id is not None:
+                self._displays.setdefault(display_id, []).append(output)
+        elif msg_or_type == 'update_display_data':
+            display_id = content.get('transient', {}).get('display_id')
+            for output in self._displays.get(display_id, []):
+                output['data'] = content['data']
+                output['metadata'] = content.get('metadata', {})
+        elif msg_or_type == 'error':
+            outputs.append({'output_type': 'error', 'ename': content['ename'],
+                            'evalue': content['evalue'], 'traceback': content['traceback']})
+        return None
+
+
+def _new_cell(source):
+    return {'cell_type': 'code', 'execution_count': None, 'id': uuid.uuid4().hex[:8],
+            'metadata': {}, 'outputs': [], 'source': source}
+
+
+def read_notebook(path):
+    """Returns the notebook (as a dict in the nbformat 4 layout) in path: an .ipynb file,
+    or a script with cells separated by `# %%` lines."""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    if path.endswith('.ipynb'):
+        return json.loads(text)
+    sources = _CELL_MARKER_RE.split(text)
+    if all(not line.strip() or line.startswith('#') for line in sources[0].splitlines()):
+        # Only a shebang or comments before the first cell marker.
+        sources = sources[1:]
+    return {
+        'cells': [_new_cell(source.strip('\n')) for source in sources],
+        'metadata': {
+            'kernelspec': {'name': 'bash', 'display_name': 'Bash', 'language': 'bash'},
+            'language_info': BashKernel.language_info,
+        },
+        'nbformat': 4,
+        'nbformat_minor': 5,
+    }
+
+
+async def run_notebook(notebook, stop_on_error=False, log=None):
+    """Runs the code cells of notebook, storing their outputs in it. Returns the timing
+    summary: the run time and status of each cell, and the total."""
+    sink = _OutputSink()
+    start = time.perf_counter()
+    # The history of the run is not kept, and nothing needs completions while cells run.
+    kernel = BashKernel(session=sink, history_file=':memory:', sidecar_bash=False)
+    summary = {'startup': time.perf_counter() - start, 'cells': [], 'status': 'ok'}
+    cells = [cell for cell in notebook['cells'] if cell['cell_type'] == 'code']
+    for cell in cells:
+        cell['outputs'] = []
+        cell['execution_count'] = None
+    try:
+        for index, cell in enumerate(cells):
+            code = cell['source']
+            if isinstance(code, list):
+                code = ''.join(code)
+            msg_id = uuid.uuid4().hex
+            sink.outputs[msg_id] = cell['outputs']
+            kernel.set_parent([], {'header': {'msg_id': msg_id, 'msg_type': 'execute_request'}},
+                              channel='shell')
+            kernel.execution_count += 1
+            reply = await kernel.do_execute(code, False, store_history=True)
+            result = {'status': reply['status'], 'exit_code': kernel._exit_code,
+                      'duration': kernel._metrics.wall_time}
+            cell['execution_count'] = kernel.execution_count
+            cell['metadata']['bash_kernel'] = result
+            summary['cells'].append(dict(result, index=index,
+                                         execution_count=kernel.execution_count))
+            if log is not None:
+                log('[%d/%d] %s in %.2f s' % (index + 1, len(cells), reply['status'],
+                                              result['duration']))
+            if reply['status'] == 'abort':
+                # The cell was interrupted: the user wants to stop the run.
+                summary['status'] = 'abort'
+                break
+            if reply['status'] != 'ok':
+                summary['status'] = 'error'
+                if stop_on_error:
+                    break
+        if kernel._parallel is not None:
+            # Let the %%parallel cells finish.
+            await asyncio.to_thread(kernel._parallel.join)
+    finally:
+        kernel.do_shutdown(False)
+    summary['total'] = time.perf_counter() - start
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m bash_kernel run',
+        description='Run a notebook, or a script with cells separated by "# %%" lines, '
+                    'with bash_kernel, and write the executed notebook'
+    )
+    parser.add_argument('input', help='Notebook (.ipynb) or script to run')
+    parser.add_argument(
+        '-o', '--output',
+        help='Executed notebook to write (default: <input>.executed.ipynb)'
+    )
+    parser.add_argument(
+        '--stop-on-error',
+        help='Stop at the first cell that fails',
+        action='store_true',
+        dest='stop_on_error'
+    )
+    parser.add_argument(
+        '--timings',
+        help='Write a JSON summary of the run times to this file ("-" for stdout)'
+    )
+    parser.add_argument(
+        '-q', '--quiet',
+        help='Don\'t report the progress on stderr',
+        action='store_true'
+    )
+    args = parser.parse_args(argv)
+
+    notebook = read_notebook(args.input)
+    log = None if args.quiet else lambda message: print(message, file=sys.stderr)
+    summary = asyncio.run(run_notebook(notebook, args.stop_on_error, log))
+
+    output = args.output or os.path.splitext(args.input)[0] + '.executed.ipynb'
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(notebook, f, indent=1, ensure_ascii=False)
+        f.write('\n')
+    if args.timings == '-':
+        json.dump(summary, sys.stdout, indent=1)
+        print()
+    elif args.timings:
+        with open(args.timings, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=1)
+    return 0 if summary['status'] == 'ok' else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
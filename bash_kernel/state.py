@@ -0,0 +1,230 @@
+"""state.py keeps track of the parts of the bash session state the kernel needs, without
+round-trips to bash.
+
+`build_cmds()` defines a bash function, `__bash_kernel_prompt`, that is run from
+PROMPT_COMMAND: before each prompt it writes the current directory, $PATH, the names of all
+functions, aliases, builtins and keywords, and the process ids of running background jobs
+to a file. It only uses builtins, so it doesn't fork, and costs well under a millisecond
+unless the session defines hundreds of functions.
+`read_state()` parses that file after each execution, and removes it.
+
+The hook is run with its stderr (and so its `set -x` trace) sent to /dev/null, and keeps the
+exit status of the last command for PS1, which shows it. A PROMPT_COMMAND of the user runs
+between `__bash_kernel_save_status` and `__bash_kernel_prompt`. When a cell replaces
+PROMPT_COMMAND, no state file is written at the next prompt: the kernel then runs
+`__bash_kernel_install_prompt`, which puts the hook back around the new PROMPT_COMMAND.
+
+The definitions of the exported variables, functions and aliases are written too, after an
+`x` line: they are what snapshots hold, see below. Comparing them to those of the previous
+prompt tells when a cell redefined a function or an alias, which their names don't.
+
+`CommandIndex` uses that state to complete command names in-process: it keeps a sorted list
+of all command names, which is only rebuilt when $PATH, the modification time of one of its
+directories or the set of functions, aliases and builtins changes. Directories in $PATH are
+listed by the kernel itself, and only when they changed.
+
+### Snapshots
+
+`write_snapshot()` saves the working directory, exported variables, functions and aliases
+of the state to a file, as a script that restores them when sourced. The kernel does so
+after successful cells, when `checkpoint_key()` of the state changed since the last
+snapshot, so the snapshot holds the state of the session right after the last successful
+cell, without running anything in bash. When bash exits, the kernel starts a new one and
+sources the snapshot, rather than leaving the user to re-run their setup cells.
+"""
+import bisect
+import os
+import shlex
+
+
+_STATE_CMD = """
+__bash_kernel_save_status () {
+    __bash_kernel_status=$?
+    return $__bash_kernel_status
+}
+
+__bash_kernel_prompt () {
+    local __bk_xtrace=
+    if [[ $- == *x* ]]; then
+        __bk_xtrace=1
+        set +x
+    fi
+    {
+        printf 'w %%s\\np %%s\\n' "$PWD" "$PATH"
+        compgen -P 'f ' -A function
+        compgen -P 'a ' -a
+        compgen -P 'b ' -b -k
+        jobs -pr
+        printf 'x\\n'
+        declare -px
+        declare -f
+        alias -p
+    } > %(state_file)s 2>/dev/null
+    if [[ $PROMPT_COMMAND != *%(prompt_hook)s ]]; then
+        # A cell added commands after the hook: they would change the exit status.
+        __bash_kernel_install_prompt
+    fi
+    [[ -z $__bk_xtrace ]] || set -x
+    return $__bash_kernel_status
+}
+
+__bash_kernel_install_prompt () {
+    local __bk_command=${PROMPT_COMMAND-}
+    __bk_command=${__bk_command//%(save_hook)s$'\\n'/}
+    __bk_command=${__bk_command//$'\\n'%(prompt_hook)s/}
+    __bk_command=${__bk_command//%(save_hook)s/}
+    __bk_command=${__bk_command//%(prompt_hook)s/}
+    PROMPT_COMMAND=%(save_hook)s$'\\n'${__bk_command:+$__bk_command$'\\n'}%(prompt_hook)s
+}
+__bash_kernel_install_prompt
+"""
+
+# Line prefixes in the state file, and the keys they are stored under by read_state().
+_STATE_LIST_KEYS = {'f': 'functions', 'a': 'aliases', 'b': 'builtins'}
+
+
+# The commands PROMPT_COMMAND starts and ends with. Their stderr goes to /dev/null, so that
+# they don't show up in the output of cells under `set -x`.
+_SAVE_HOOK = '{ __bash_kernel_save_status; } 2>/dev/null'
+_PROMPT_HOOK = '{ __bash_kernel_prompt; } 2>/dev/null'
+
+
+def build_cmds(state_file):
+    return _STATE_CMD % {'state_file': shlex.quote(state_file),
+                         'save_hook': shlex.quote(_SAVE_HOOK),
+                         'prompt_hook': shlex.quote(_PROMPT_HOOK)}
+
+
+def read_state(state_file):
+    """Returns the session state written by `__bash_kernel_prompt`, or None if it can't be read.
+
+    The file is removed, so that None is returned if the hook didn't run at the last prompt.
+    """
+    try:
+        with open(state_file, 'rb') as f:
+            data = f.read()
+        os.remove(state_file)
+    except OSError:
+        return None
+    # The definitions may span several lines, so they come last. They are kept as bytes, to
+    # be saved as they are by write_snapshot().
+    data, _, definitions = data.partition(b'\nx\n')
+    state = {'cwd': '', 'path': '', 'functions': [], 'aliases': [], 'builtins': [],
+             'jobs': [], 'definitions': definitions}
+    for line in data.decode('utf-8', errors='replace').splitlines():
+        kind, value = line[:1], line[2:]
+        if line.isdigit():
+            # The process id of a running background job.
+            state['jobs'].append(int(line))
+        elif kind == 'w':
+            state['cwd'] = value
+        elif kind == 'p':
+            state['path'] = value
+        elif kind in _STATE_LIST_KEYS:
+            state[_STATE_LIST_KEYS[kind]].append(value)
+    return state
+
+
+def checkpoint_key(state):
+    """Returns what is compared to decide whether the session needs a new snapshot."""
+    if state is None:
+        return None
+    return (state['cwd'], state['definitions'])
+
+
+def write_snapshot(state, snapshot_file):
+    """Saves the working directory, exported variables, functions and aliases of state to
+    snapshot_file, as a script restoring them when sourced."""
+    # Written to another file first, so that a snapshot being written is never sourced.
+    temp_file = '%s.%d.tmp' % (snapshot_file, os.getpid())
+    with open(temp_file, 'wb') as f:
+        f.write(state['definitions'])
+        f.write(b'\ncd -- %s\n' % shlex.quote(state['cwd']).encode('utf-8'))
+    os.replace(temp_file, snapshot_file)
+
+
+def _mtime(directory):
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _list_executables(directory):
+    names = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and os.access(entry.path, os.X_OK):
+                        names.append(entry.name)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return names
+
+
+class CommandIndex:
+    """Prefix index of the command names of a bash session, like `compgen -abck -A function`.
+
+    `update()` runs in the thread running cells, while `complete()` may run concurrently in
+    the event loop, so the key of the index and the names built for it are kept together in
+    a tuple, replaced in a single assignment.
+    """
+    def __init__(self):
+        # Maps directory -> (modification time, executables), for the directories of $PATH.
+        self._directories = {}
+        # (key, sorted names, or None until needed).
+        self._index = (None, None)
+
+    def update(self, state):
+        """Invalidates the index if the commands of the session may have changed."""
+        if state is None:
+            return
+        directories = []
+        for directory in state['path'].split(':'):
+            # Empty and relative entries of $PATH are relative to the current directory.
+            directories.append(os.path.join(state['cwd'], directory or '.'))
+        key = (tuple((d, _mtime(d)) for d in directories),
+               tuple(state['functions']), tuple(state['aliases']), tuple(state['builtins']))
+        if key != self._index[0]:
+            self._index = (key, None)
+
+    def _build(self, key):
+        directories, functions, aliases, builtins = key
+        names = set(functions)
+        names.update(aliases)
+        names.update(builtins)
+        cache = {}
+        for directory, mtime in directories:
+            if mtime is None:
+                continue
+            cached = self._directories.get(directory)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, _list_executables(directory))
+            cache[directory] = cached
+            names.update(cached[1])
+        # Forget about directories no longer in $PATH.
+        self._directories = cache
+        return sorted(names)
+
+    def complete(self, prefix, limit=None):
+        """Returns the command names starting with prefix, in sorted order."""
+        index = self._index
+        key, names = index
+        if key is None:
+            return []
+        if names is None:
+            names = self._build(key)
+            if self._index is index:
+                # Unless update() invalidated the index meanwhile.
+                self._index = (key, names)
+        matches = []
+        pos = bisect.bisect_left(names, prefix)
+        while pos < len(names) and names[pos].startswith(prefix):
+            matches.append(names[pos])
+            if limit is not None and len(matches) >= limit:
+                break
+            pos += 1
+        return matches
@@ -0,0 +1,280 @@
+"""syntax.py tells whether a piece of bash code is complete, without asking bash.
+
+Frontends like jupyter console send an is_complete request whenever the user presses enter,
+to decide between running the code and starting a new line. `is_complete()` answers those
+in-process, with a small scanner that follows just enough of the bash grammar: quotes,
+backslash continuations, comments, `$(...)`, `${...}`, backticks, arithmetic, here
+documents, `{ ...; }` groups and the `if`/`case`/`for`/`while`/`until`/`select` compound
+commands, and lines ending with `|`, `&&` or `||`. Results are memoized per code string,
+since the same code is often checked more than once.
+
+It is not a full parser: code it deems complete may still be a syntax error for bash, which
+bash then reports when the code runs.
+"""
+import functools
+import re
+
+
+# Words that start a compound command, and the word that ends it. The body of `for` and
+# `select` loops is either `do ...; done` or `{ ...; }`: they wait for one of those first.
+_OPENERS = {'if': 'fi', 'case': 'esac', 'for': 'do', 'select': 'do', 'while': 'done',
+            'until': 'done', '{': '}'}
+_CLOSERS = {'fi', 'esac', 'done', '}'}
+# Reserved words after which a command is expected.
+_COMMAND_PREFIXES = {'then', 'else', 'elif', 'do', '!', 'time', 'if', 'while', 'until', '{'}
+_METACHARS = ' \t\n;&|<>()'
+_WORD_RE = re.compile(r'''[^\s;&|<>()'"`\\$]+''')
+_FUNCTION_NAME_RE = re.compile(r'''[ \t]+[^\s;&|<>()'"]+(?:[ \t]*\([ \t]*\))?''')
+_HEREDOC_RE = re.compile(r'''<<(-?)[ \t]*(?:'([^']*)'|"([^"]*)"|\\?([^\s;&|<>()'"]+))''')
+
+# The number of spaces of indent per open block, for incomplete code.
+INDENT = 4
+
+
+class _Incomplete(Exception):
+    pass
+
+
+class _Invalid(Exception):
+    pass
+
+
+def _skip_quoted(code, pos, escapes):
+    """Returns the position after the single quote closing the string starting at pos."""
+    while pos < len(code):
+        char = code[pos]
+        if char == "'":
+            return pos + 1
+        pos += 2 if escapes and char == '\\' else 1
+    raise _Incomplete
+
+
+def _skip_heredocs(code, pos, heredocs):
+    """Returns the position after the bodies of heredocs, which start at pos."""
+    for strip_tabs, delimiter in heredocs:
+        while True:
+            end = code.find('\n', pos)
+            line = code[pos:] if end == -1 else code[pos:end]
+            if (line.lstrip('\t') if strip_tabs else line) == delimiter:
+                pos = len(code) if end == -1 else end + 1
+                break
+            if end == -1:
+                raise _Incomplete
+            pos = end + 1
+    return pos
+
+
+def _scan(code):
+    """Scans code, returning the stack of constructs still open at its end."""
+    # What closes each open construct: a closing word ('fi', '}', ...), ')', '))', '`',
+    # '"' or '${'. Open `case` commands are ['esac', in_pattern], 'do' stands for the header
+    # of `for` and `select` loops, and '()' for parentheses within arithmetic.
+    stack = []
+    heredocs = []
+    command_position = True
+    # Whether the last operator needs a command after it (e.g. `|`).
+    needs_command = False
+    pos = 0
+    n = len(code)
+    while pos < n:
+        char = code[pos]
+        top = stack[-1] if stack else None
+        if top == '"' or top == '${':
+            # Within double quotes or ${...}: only look for the end, and substitutions.
+            if char == '\\':
+                pos += 2
+                if pos > n:
+                    raise _Incomplete
+                continue
+            if (char == '"' and top == '"') or (char == '}' and top == '${'):
+                stack.pop()
+                pos += 1
+                continue
+            if char == '"':
+                stack.append('"')
+                pos += 1
+                continue
+        elif char in ' \t':
+            pos += 1
+            continue
+        elif char == '\n':
+            pos = _skip_heredocs(code, pos + 1, heredocs)
+            heredocs = []
+            command_position = True
+            continue
+        elif char == '#' and (pos == 0 or code[pos - 1] in _METACHARS):
+            end = code.find('\n', pos)
+            pos = n if end == -1 else end
+            continue
+
+        # Substitutions and quotes, which start or continue a word.
+        if char == '$' and code.startswith('$((', pos):
+            stack.append('))')
+            pos += 3
+        elif char == '$' and code.startswith('$(', pos):
+            stack.append(')')
+            command_position = True
+            pos += 2
+            continue
+        elif char == '$' and code.startswith('${', pos):
+            stack.append('${')
+            pos += 2
+        elif char == '`':
+            if top == '`':
+                stack.pop()
+            else:
+                stack.append('`')
+                command_position = True
+                pos += 1
+                continue
+            pos += 1
+        elif top == '"' or top == '${':
+            pos += 1
+            continue
+        elif char == '\\':
+            if pos + 1 >= n:
+                raise _Incomplete
+            pos += 2
+        elif char == "'":
+            pos = _skip_quoted(code, pos + 1, escapes=False)
+        elif char == '$' and code.startswith("$'", pos):
+            pos = _skip_quoted(code, pos + 2, escapes=True)
+        elif char == '"':
+            stack.append('"')
+            pos += 1
+        # Operators.
+        elif char in ';&|':
+            operator = re.match(r';;&|;;|;&|&&|\|\||[;&|]', code[pos:pos + 3]).group()
+            if operator in (';;', ';&', ';;&') and isinstance(top, list):
+                # End of a case item: a pattern follows.
+                top[1] = True
+            needs_command = operator in ('&&', '||', '|')
+            command_position = True
+            pos += len(operator)
+            continue
+        elif char in '<>':
+            if top in ('))', '()'):
+                # Comparison or shift in arithmetic, e.g. $(( 1 << 2 )).
+                pos += 1
+                continue
+            if code.startswith('<<<', pos):
+                # Here string.
+                pos += 3
+                continue
+            match = _HEREDOC_RE.match(code, pos)
+            if match is not None:
+                heredocs.append((bool(match.group(1)),
+                                 next(g for g in match.groups()[1:] if g is not None)))
+                pos = match.end()
+                continue
+            if code.startswith('(', pos + 1):
+                # Process substitution.
+                stack.append(')')
+                command_position = True
+                pos += 2
+                continue
+            pos += 1
+            continue
+        elif char == '(':
+            if top in ('))', '()'):
+                stack.append('()')
+                pos += 1
+                continue
+            if isinstance(top, list) and top[1]:
+                # Optional opening parenthesis of a case pattern.
+                pos += 1
+                continue
+            if re.match(r'\(\s*\)', code[pos:pos + 80]):
+                # Function definition, the body follows.
+                pos = code.index(')', pos) + 1
+                command_position = True
+                continue
+            if (command_position or top == 'do') and code.startswith('((', pos):
+                # Arithmetic command, or the header of a C-style `for` loop.
+                stack.append('))')
+                pos += 2
+                continue
+            stack.append(')')
+            command_position = True
+            pos += 1
+            continue
+        elif char == ')':
+            if isinstance(top, list) and top[1]:
+                # End of a case pattern: a command follows.
+                top[1] = False
+                command_position = True
+                pos += 1
+                continue
+            if top == '))' and code.startswith('))', pos):
+                stack.pop()
+                pos += 2
+                if stack and stack[-1] == 'do':
+                    # End of the header of `for ((...))`: its body may follow.
+                    command_position = True
+                    continue
+            elif top in (')', '()'):
+                stack.pop()
+                pos += 1
+            else:
+                raise _Invalid
+            command_position = False
+            continue
+        else:
+            match = _WORD_RE.match(code, pos)
+            word = match.group() if match else char
+            pos += len(word)
+            needs_command = False
+            at_word_end = pos >= n or code[pos] in _METACHARS
+            if isinstance(top, list) and top[1]:
+                # Case patterns are not commands, but `esac` may end the case.
+                if word == 'esac' and at_word_end:
+                    stack.pop()
+                    command_position = False
+                continue
+            if command_position and at_word_end:
+                if word == 'function':
+                    # The name of the function, and the body that follows.
+                    match = _FUNCTION_NAME_RE.match(code, pos)
+                    if match is not None:
+                        pos = match.end()
+                    continue
+                if top == 'do' and word in ('do', '{'):
+                    # The body of a `for` or `select` loop.
+                    stack[-1] = 'done' if word == 'do' else '}'
+                    command_position = True
+                    continue
+                if word in _OPENERS:
+                    stack.append(['esac', True] if word == 'case' else _OPENERS[word])
+                elif word in _CLOSERS:
+                    expected = top[0] if isinstance(top, list) else top
+                    if expected != word:
+                        raise _Invalid
+                    stack.pop()
+                    command_position = False
+                    continue
+                command_position = word in _COMMAND_PREFIXES
+                continue
+            command_position = False
+            continue
+        needs_command = False
+        command_position = False
+    if heredocs or needs_command:
+        raise _Incomplete
+    return stack
+
+
+@functools.lru_cache(maxsize=256)
+def is_complete(code):
+    """Returns ('complete', ''), ('incomplete', indent) or ('invalid', '') for code."""
+    try:
+        stack = _scan(code)
+    except _Incomplete:
+        return 'incomplete', ''
+    except _Invalid:
+        return 'invalid', ''
+    if not stack:
+        return 'complete', ''
+    if stack[-1] in ('"', '`', '${'):
+        # Within a string: any indent would be part of it.
+        return 'incomplete', ''
+    return 'incomplete', ' ' * INDENT * len(stack)
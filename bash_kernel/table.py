@@ -0,0 +1,211 @@
+"""table.py summarizes CSV/TSV data for the `displayTable` command, however large it is.
+
+$ zcat measurements.tsv.gz | displayTable
+$ displayTable --rows=5 --delimiter=';' < export.csv
+
+Rather than saving its input for the kernel, like the other display functions do,
+`displayTable` pipes it through this script (run by the kernel's Python, without importing
+the rest of bash_kernel). `summarize()` parses the rows as they stream by and only keeps:
+
+- the header (the first row), and the first and last `rows` rows,
+- the number of rows,
+- for each column, its type (int, float or text), the number of empty values and, for
+  numbers, the minimum and maximum.
+
+So memory stays bounded whatever the size of the input, and the summary written for the
+kernel is small. The delimiter is guessed from the header (tab, comma, semicolon or |)
+unless given. `table_display_data()` renders the summary as text and as an HTML table,
+with a row marking the rows left out between the head and the tail.
+"""
+import collections
+import csv
+import html
+import io
+import json
+import sys
+
+
+# Number of rows shown at the start and at the end of the table, by default.
+TABLE_ROWS = 10
+
+# Values are cut to this many characters in the summary.
+MAX_VALUE_LENGTH = 200
+
+# Delimiters recognized in the header, and the names they can be given by.
+_DELIMITERS = '\t,;|'
+_DELIMITER_NAMES = {'tab': '\t', 'comma': ',', 'semicolon': ';', 'pipe': '|'}
+
+# Column types, from the most to the least specific.
+_TYPES = ('int', 'float', 'text')
+
+
+def _guess_delimiter(line):
+    counts = [(line.count(delimiter), delimiter) for delimiter in _DELIMITERS]
+    count, delimiter = max(counts)
+    return delimiter if count else ','
+
+
+def _cut(value):
+    if len(value) > MAX_VALUE_LENGTH:
+        return value[:MAX_VALUE_LENGTH - 1] + '…'
+    return value
+
+
+class _ColumnStats:
+    def __init__(self, name):
+        self.name = name
+        self.type = 0
+        self.empty = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        value = value.strip()
+        if not value:
+            self.empty += 1
+            return
+        if self.type == 2:
+            # Text: nothing more to learn.
+            return
+        if self.type == 0:
+            try:
+                number = int(value)
+            except ValueError:
+                self.type = 1
+        if self.type == 1:
+            try:
+                number = float(value)
+            except ValueError:
+                self.type = 2
+                self.min = self.max = None
+                return
+        if self.min is None or number < self.min:
+            self.min = number
+        if self.max is None or number > self.max:
+            self.max = number
+
+    def to_dict(self):
+        return {'name': self.name, 'type': _TYPES[self.type], 'empty': self.empty,
+                'min': self.min, 'max': self.max}
+
+
+def summarize(stream, rows=TABLE_ROWS, delimiter=None):
+    """Returns the summary (a dict) of the CSV/TSV data read from the text stream."""
+    first_line = stream.readline()
+    if delimiter is None:
+        delimiter = _guess_delimiter(first_line)
+    summary = {'delimiter': delimiter, 'header': [], 'head': [], 'tail': [], 'rows': 0,
+               'columns': [], 'error': None}
+    if not first_line:
+        return summary
+    header = next(csv.reader([first_line], delimiter=delimiter), [])
+    columns = [_ColumnStats(_cut(name)) for name in header]
+    head = []
+    tail = collections.deque(maxlen=rows)
+    count = 0
+    try:
+        for row in csv.reader(stream, delimiter=delimiter):
+            if not row:
+                continue
+            while len(columns) < len(row):
+                columns.append(_ColumnStats(''))
+            for column, value in zip(columns, row):
+                column.add(value)
+            count += 1
+            if len(head) < rows:
+                head.append([_cut(value) for value in row])
+            elif rows:
+                tail.append(row)
+    except csv.Error as e:
+        summary['error'] = 'line %d: %s' % (count + 2, e)
+    summary['header'] = [column.name for column in columns]
+    summary['head'] = head
+    summary['tail'] = [[_cut(value) for value in row] for row in tail]
+    summary['rows'] = count
+    summary['columns'] = [column.to_dict() for column in columns]
+    return summary
+
+
+def _format_number(number):
+    if isinstance(number, float):
+        return '%.6g' % number
+    return '{:,}'.format(number)
+
+
+def _column_description(column):
+    description = column['type']
+    if column['min'] is not None:
+        description += ' %s..%s' % (_format_number(column['min']),
+                                    _format_number(column['max']))
+    if column['empty']:
+        description += ', %s empty' % _format_number(column['empty'])
+    return description
+
+
+def table_display_data(summary):
+    """Returns the display_data content showing summary as a table."""
+    header = summary['header']
+    rows = summary['head'] + summary['tail']
+    skipped = summary['rows'] - len(rows)
+    width = len(header)
+    rows = [row + [''] * (width - len(row)) for row in rows]
+    totals = '%s rows × %d columns' % (_format_number(summary['rows']), width)
+    if summary['error']:
+        totals += ' (stopped at %s)' % summary['error']
+    skipped_text = '… %s more rows …' % _format_number(skipped)
+
+    widths = [max([len(value) for value in column] + [1])
+              for column in zip(header, *rows)]
+    text_lines = [' | '.join(value.ljust(w) for value, w in zip(row, widths))
+                  for row in [header] + rows]
+    if skipped:
+        text_lines.insert(1 + len(summary['head']), skipped_text)
+    text_lines.append(totals)
+    text_lines.extend('%s: %s' % (column['name'], _column_description(column))
+                      for column in summary['columns'])
+
+    def html_row(row, cell='td'):
+        return '<tr>%s</tr>' % ''.join('<%s>%s</%s>' % (cell, html.escape(value), cell)
+                                       for value in row)
+    html_rows = [html_row(header, 'th')]
+    html_rows.extend(html_row(row) for row in rows[:len(summary['head'])])
+    if skipped:
+        html_rows.append('<tr><td colspan="%d" style="text-align:center">%s</td></tr>'
+                         % (width, html.escape(skipped_text)))
+    html_rows.extend(html_row(row) for row in rows[len(summary['head']):])
+    html_rows.append(html_row([_column_description(column) for column in summary['columns']]))
+    return {
+        'data': {
+            'text/plain': '\n'.join(text_lines),
+            'text/html': '<table>%s<caption style="caption-side:bottom">%s</caption></table>'
+                         % (''.join(html_rows), html.escape(totals)),
+        },
+        'metadata': {}
+    }
+
+
+def main(argv):
+    """Summarizes stdin to stdout. The arguments are the options of displayTable, as
+    name=value. Returns the exit status."""
+    options = dict(arg.partition('=')[::2] for arg in argv)
+    try:
+        rows = int(options.get('rows') or TABLE_ROWS)
+    except ValueError:
+        print('displayTable: invalid --rows "%s", use a number of rows' % options['rows'],
+              file=sys.stderr)
+        return 2
+    delimiter = options.get('delimiter') or None
+    if delimiter is not None:
+        delimiter = _DELIMITER_NAMES.get(delimiter, delimiter)
+        if len(delimiter) != 1:
+            json.dump({'error': 'Invalid delimiter "%s", use a single character or one of: %s'
+                                % (delimiter, ', '.join(sorted(_DELIMITER_NAMES)))},
+                      sys.stdout)
+            return
+    stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', errors='replace',
+                              newline='')
+    json.dump(summarize(stream, max(rows, 0), delimiter), sys.stdout)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
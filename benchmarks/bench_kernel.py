@@ -0,0 +1,243 @@
+"""Benchmarks of the hot paths of bash_kernel.
+
+Runs offline, against a real local bash, with the kernel's messages serialized by a real
+jupyter_client Session but sent to an in-memory socket instead of ZMQ. Results are printed
+(or written to --output) as JSON, so that they can be compared between releases:
+
+    python benchmarks/bench_kernel.py --output bench_output.json
+    python benchmarks/bench_kernel.py --quick --only throughput,latency
+
+The bash_kernel that is imported is the one on sys.path, so running this script from
+another checkout (or against an installed release) measures that version.
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+from jupyter_client.session import Session
+
+import bash_kernel
+from bash_kernel import display
+from bash_kernel.kernel import BashKernel
+
+
+class FakeSocket:
+    """Stands in for the iopub socket, counting the messages and bytes sent to it."""
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def send_multipart(self, msg_parts, copy=True, **kwargs):
+        self.messages += 1
+        self.bytes += sum(len(part) for part in msg_parts)
+
+
+# do_execute and do_shutdown are coroutines in some releases.
+_loop = asyncio.new_event_loop()
+
+
+def start_kernel():
+    # Keep the cells run out of the history of the user, in releases that have one.
+    options = {'history_file': ':memory:'}
+    traits = BashKernel.class_trait_names()
+    kernel = BashKernel(session=Session(),
+                        **{name: value for name, value in options.items() if name in traits})
+    kernel.iopub_socket = FakeSocket()
+    return kernel
+
+
+def execute(kernel, code):
+    reply = kernel.do_execute(code, False)
+    if inspect.isawaitable(reply):
+        reply = _loop.run_until_complete(reply)
+    if reply['status'] != 'ok':
+        raise RuntimeError('Cell failed: %r -> %r' % (code, reply))
+    return reply
+
+
+def shutdown(kernel):
+    result = kernel.do_shutdown(False)
+    if inspect.isawaitable(result):
+        _loop.run_until_complete(result)
+
+
+def _timings(samples):
+    samples = sorted(samples)
+    return {
+        'min_ms': samples[0] * 1000,
+        'median_ms': statistics.median(samples) * 1000,
+        'p95_ms': samples[int(0.95 * (len(samples) - 1))] * 1000,
+        'max_ms': samples[-1] * 1000,
+        'samples': len(samples),
+    }
+
+
+def bench_startup(args):
+    """Kernel startup time, and time until the first execution finished."""
+    samples = []
+    first_execute = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        kernel = start_kernel()
+        t1 = time.perf_counter()
+        execute(kernel, 'true')
+        t2 = time.perf_counter()
+        samples.append(t1 - t0)
+        first_execute.append(t2 - t0)
+        shutdown(kernel)
+        kernel.bashwrapper.child.close(force=True)
+    return {'startup': _timings(samples), 'time_to_first_execute': _timings(first_execute)}
+
+
+def bench_throughput(kernel, args):
+    """Stdout throughput of chatty commands, and the messages it took to send the output."""
+    results = {}
+    cases = {
+        'short_lines': ('seq %d' % args.lines, args.lines),
+        'long_lines': ('head -c %d /dev/zero | tr "\\0" x | fold -w 200' % args.bytes, None),
+        'progress_bar': ('for ((i=0; i<%d; i++)); do printf "%%d%%%%\\r" $i; done; echo'
+                         % (args.lines // 10), None),
+    }
+    for name, (code, lines) in cases.items():
+        socket = kernel.iopub_socket
+        messages, sent_bytes = socket.messages, socket.bytes
+        t0 = time.perf_counter()
+        execute(kernel, code)
+        elapsed = time.perf_counter() - t0
+        result = {
+            'seconds': elapsed,
+            'iopub_messages': socket.messages - messages,
+            'iopub_mb': (socket.bytes - sent_bytes) / 1e6,
+            'iopub_mb_per_s': (socket.bytes - sent_bytes) / 1e6 / elapsed,
+        }
+        if lines is not None:
+            result['lines_per_s'] = lines / elapsed
+        results[name] = result
+    return results
+
+
+def bench_latency(kernel, args):
+    """Round-trip time of trivial cells."""
+    samples = []
+    for _ in range(args.cells):
+        t0 = time.perf_counter()
+        execute(kernel, 'true')
+        samples.append(time.perf_counter() - t0)
+    return {'trivial_cell': _timings(samples)}
+
+
+def bench_completion(kernel, args):
+    """Completion latency for command names, and paths in a large directory."""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='bash_kernel_bench.') as directory:
+        for i in range(args.files):
+            open(os.path.join(directory, 'file%06d' % i), 'w').close()
+        requests = {
+            'command_name': 'ec',
+            'large_directory': 'ls %s/file' % directory,
+            'large_directory_prefix': 'ls %s/file0001' % directory,
+            'variable': 'echo $HO',
+        }
+        for name, code in requests.items():
+            samples = []
+            for _ in range(args.repeat * 5):
+                t0 = time.perf_counter()
+                kernel.do_complete(code, len(code))
+                samples.append(time.perf_counter() - t0)
+            results[name] = _timings(samples)
+    return results
+
+
+def bench_display(kernel, args):
+    """Latency of rich displays, by payload size."""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='bash_kernel_bench.') as directory:
+        for size in (1000, 100000, 1000000, 10000000):
+            filename = os.path.join(directory, 'payload.html')
+            with open(filename, 'w') as f:
+                f.write('x' * size)
+            samples = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                execute(kernel, 'displayHTML < %s' % filename)
+                samples.append(time.perf_counter() - t0)
+            results['html_%d_bytes' % size] = _timings(samples)
+    return results
+
+
+def bench_display_parsing(args):
+    """Splitting lines and extracting rich content markers, without bash."""
+    plain = ''.join('line %d of some output\n' % i for i in range(args.lines))
+    progress = ''.join('%d%%\r' % i for i in range(args.lines))
+    results = {}
+    for name, fn, text in [('split_lines', display.split_lines, plain),
+                           ('extract_contents_plain', display.extract_contents, plain),
+                           ('extract_contents_progress', display.extract_contents, progress)]:
+        samples = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            fn(text)
+            samples.append(time.perf_counter() - t0)
+        result = _timings(samples)
+        result['mb_per_s'] = len(text) / 1e6 / min(samples)
+        results[name] = result
+    return results
+
+
+BENCHMARKS = ['startup', 'throughput', 'latency', 'completion', 'display', 'display_parsing']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of bash_kernel')
+    parser.add_argument('--output', help='Write the JSON results to this file')
+    parser.add_argument('--only', help='Comma separated benchmarks to run, out of: '
+                        + ', '.join(BENCHMARKS))
+    parser.add_argument('--quick', action='store_true', help='Smaller sizes, fewer repeats')
+    args = parser.parse_args(argv)
+    quick = args.quick
+    args.repeat = 3 if quick else 10
+    args.lines = 20000 if quick else 200000
+    args.bytes = 2000000 if quick else 50000000
+    args.cells = 20 if quick else 200
+    args.files = 2000 if quick else 20000
+    selected = args.only.split(',') if args.only else BENCHMARKS
+
+    results = {}
+    if 'startup' in selected:
+        results['startup'] = bench_startup(args)
+    if 'display_parsing' in selected:
+        results['display_parsing'] = bench_display_parsing(args)
+    if set(selected) & {'throughput', 'latency', 'completion', 'display'}:
+        kernel = start_kernel()
+        try:
+            for name, fn in [('throughput', bench_throughput), ('latency', bench_latency),
+                             ('completion', bench_completion), ('display', bench_display)]:
+                if name in selected:
+                    results[name] = fn(kernel, args)
+        finally:
+            shutdown(kernel)
+
+    report = {
+        'bash_kernel_version': bash_kernel.__version__,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': quick,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()